@@ -24,6 +24,50 @@
 # You will then be prompted for your Earthdata username/password
 # and the script will download the matching files.
 #
+# To download several files at the same time, pass the number of parallel
+# downloads with --workers, e.g.:
+#   $ python nsidc-data-download.py --workers=8
+#
+# Earthdata Login cookies can be kept between runs, so that later runs go
+# straight to the data without logging in again, with --cookie-jar, e.g.:
+#   $ python nsidc-data-download.py --cookie-jar=$HOME/.urs_cookies
+#
+# Large files can be fetched as several byte ranges in parallel, which helps
+# on long-distance links. E.g. to split files of 100 MB or more into 8 parts:
+#   $ python nsidc-data-download.py --segments=8 --segment-threshold=100
+#
+# Search results are cached for an hour in ~/.nsidc_cmr_cache.sqlite, so
+# re-running the same query does not search Earthdata again. Use
+# --cache-ttl=SECONDS to change how long results are reused, or --no-cache
+# to always search.
+#
+# Every downloaded file is recorded in .nsidc_manifest.sqlite together with
+# its size, CMR update time and checksum. To refresh a local mirror, fetching
+# only files that are new or have changed since they were recorded, use:
+#   $ python nsidc-data-download.py --sync
+#
+# Files are saved in the current directory, or in the one given with
+# --directory, e.g.:
+#   $ python nsidc-data-download.py --directory=$HOME/atl10 --sync
+#
+# Searches over long time ranges can be split into several time windows that
+# are searched at the same time; this needs both time_start and time_end, e.g.:
+#   $ python nsidc-data-download.py --search-shards=8
+#
+# To record how long each file took (time to first byte, time spent on login
+# redirects, bytes, throughput, retries and status) as JSON lines, with a
+# summary line for the whole run, use:
+#   $ python nsidc-data-download.py --metrics=download_metrics.jsonl
+#
+# When running in AWS us-west-2, protected files can be read directly from
+# S3, which is faster and avoids egress charges. Files that cannot be read
+# from S3 are downloaded over HTTPS as usual:
+#   $ python nsidc-data-download.py --s3
+#
+# The script can also be imported and used from other Python programs through
+# NSIDCDownloadClient, which takes credentials as arguments, raises exceptions
+# instead of exiting and returns a result for each downloaded file.
+#
 # If you wish, you may store your Earthdata username/password in a .netrc
 # file in your $HOME directory and the script will automatically attempt to
 # read this file. The .netrc file should have the following format:
@@ -41,24 +85,50 @@
 from __future__ import print_function
 
 import base64
+import bz2
 import getopt
+import hashlib
+import hmac
 import itertools
 import json
 import math
 import netrc
 import os.path
+import socket
+import sqlite3
 import ssl
 import sys
+import threading
 import time
+import zlib
+from contextlib import closing
+from datetime import datetime
 from getpass import getpass
 
 try:
-    from urllib.parse import urlparse
-    from urllib.request import urlopen, Request, build_opener, HTTPCookieProcessor
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import http.client as http_client
+    from http.cookiejar import MozillaCookieJar, LoadError
+    from urllib.parse import urlparse, quote
+    from urllib.request import (urlopen, Request, build_opener, HTTPCookieProcessor,
+                                HTTPHandler, HTTPSHandler, HTTPRedirectHandler)
     from urllib.error import HTTPError, URLError
 except ImportError:
+    import httplib as http_client
+    from cookielib import MozillaCookieJar, LoadError
     from urlparse import urlparse
-    from urllib2 import urlopen, Request, HTTPError, URLError, build_opener, HTTPCookieProcessor
+    from urllib import quote
+    from urllib2 import (urlopen, Request, HTTPError, URLError, build_opener, HTTPCookieProcessor,
+                         HTTPHandler, HTTPSHandler, HTTPRedirectHandler)
+try:
+    NETWORK_ERRORS = (http_client.HTTPException, socket.timeout, ConnectionError)
+except NameError:
+    # Python 2
+    NETWORK_ERRORS = (http_client.HTTPException, socket.timeout, socket.error)
 # flake8: noqa
 short_name = ''
 version = ''
@@ -77,6 +147,71 @@ CMR_FILE_URL = ('{0}/search/granules.json?'
 CMR_COLLECTIONS_URL = '{0}/search/collections.json?'.format(CMR_URL)
 # Maximum number of times to re-try downloading a file if something goes wrong.
 FILE_DOWNLOAD_MAX_RETRIES = 3
+# Local cache of CMR collection lookups and granule search pages, so that
+# repeated runs of the same query do not search CMR again. Responses older than
+# CMR_CACHE_TTL seconds are fetched again. Override with --cache-ttl, or skip
+# the cache with --no-cache.
+CMR_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.nsidc_cmr_cache.sqlite')
+CMR_CACHE_TTL = 60 * 60
+# Record of downloaded files (url, size, CMR update time and checksum) kept in
+# the download directory. With --sync only files that are new or have changed
+# in CMR since they were recorded are downloaded. Override with --manifest.
+MANIFEST_FILE = '.nsidc_manifest.sqlite'
+MANIFEST_CHECKSUM = 'sha256'
+# Number of files downloaded at the same time. Override with --workers.
+DOWNLOAD_WORKERS = 1
+# Maximum number of simultaneous downloads from any single host.
+MAX_CONNECTIONS_PER_HOST = 4
+# File in which Earthdata Login cookies are kept between runs so that later
+# runs can skip the login redirects. Empty means keep cookies in memory only.
+# Override with --cookie-jar.
+URS_COOKIE_JAR = ''
+# Files at least SEGMENTED_DOWNLOAD_THRESHOLD bytes long are fetched as this
+# many byte ranges in parallel. 1 disables segmented downloads. Override with
+# --segments and --segment-threshold (in MB).
+SEGMENTED_DOWNLOAD_SEGMENTS = 1
+SEGMENTED_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024
+# Direct S3 access for jobs running in AWS us-west-2, enabled with --s3.
+# Protected HTTPS links under S3_PROTECTED_URL are fetched from the S3 bucket
+# named by the first part of their path instead, using temporary credentials
+# from S3_CREDENTIALS_URL. Files of at least S3_SEGMENT_THRESHOLD bytes are
+# fetched as S3_SEGMENTS concurrent range GETs. Files that cannot be read
+# from S3 (e.g. when running outside us-west-2) are downloaded over HTTPS.
+# --s3-endpoint-url points the S3 requests at an S3-compatible server.
+S3_PROTECTED_URL = 'https://data.nsidc.earthdatacloud.nasa.gov'
+S3_CREDENTIALS_URL = S3_PROTECTED_URL + '/s3credentials'
+S3_REGION = 'us-west-2'
+S3_ENDPOINT_URL = ''
+S3_SEGMENTS = 8
+S3_SEGMENT_THRESHOLD = 32 * 1024 * 1024
+# Temporary credentials are replaced this many seconds before they expire.
+S3_CREDENTIALS_REFRESH_MARGIN = 5 * 60
+# Minimum number of seconds between redraws of the progress display.
+PROGRESS_REFRESH_INTERVAL = 0.25
+# File to which a JSON record is appended for every file and every run, with
+# timings, sizes, throughput, retries and status. '-' writes to standard
+# output; empty disables metrics. Override with --metrics.
+METRICS_FILE = ''
+
+
+class NSIDCDownloadError(RuntimeError):
+    """Base class for errors raised by the search and download functions."""
+
+
+class AuthenticationError(NSIDCDownloadError):
+    """Earthdata Login rejected the credentials, or none were available."""
+
+
+class CMRSearchError(NSIDCDownloadError):
+    """A CMR search could not be completed."""
+
+
+class TemporalRangeError(CMRSearchError, ValueError):
+    """A search time bound is malformed or the range ends before it starts."""
+
+
+class S3AccessError(NSIDCDownloadError):
+    """Direct S3 access is not available; downloads fall back to HTTPS."""
 
 
 def get_username():
@@ -106,8 +241,18 @@ def get_token():
     return token
 
 
-def get_login_credentials():
-    """Get user credentials from .netrc or prompt for input."""
+def encode_credentials(username, password):
+    """Return the Basic authorization string for an Earthdata username/password."""
+    credentials = '{0}:{1}'.format(username, password)
+    return base64.b64encode(credentials.encode('ascii')).decode('ascii')
+
+
+def get_login_credentials(interactive=True):
+    """Get user credentials from .netrc or prompt for input.
+
+    With `interactive` False, AuthenticationError is raised instead of
+    prompting when .netrc has no Earthdata entry.
+    """
     credentials = None
     token = None
 
@@ -117,18 +262,20 @@ def get_login_credentials():
         if username == 'token':
             token = password
         else:
-            credentials = '{0}:{1}'.format(username, password)
-            credentials = base64.b64encode(credentials.encode('ascii')).decode('ascii')
+            credentials = encode_credentials(username, password)
     except Exception:
         username = None
         password = None
 
     if not username:
+        if not interactive:
+            raise AuthenticationError(
+                'No Earthdata Login credentials found in .netrc for {0}'.format(
+                    urlparse(URS_URL).hostname))
         username = get_username()
         if len(username):
             password = get_password()
-            credentials = '{0}:{1}'.format(username, password)
-            credentials = base64.b64encode(credentials.encode('ascii')).decode('ascii')
+            credentials = encode_credentials(username, password)
         else:
             token = get_token()
 
@@ -138,8 +285,7 @@ def get_login_credentials():
 def build_version_query_params(version):
     desired_pad_length = 3
     if len(version) > desired_pad_length:
-        print('Version string too long: "{0}"'.format(version))
-        quit()
+        raise CMRSearchError('Version string too long: "{0}"'.format(version))
 
     version = str(int(version))  # Strip off any leading zeros
     query_params = ''
@@ -234,137 +380,1436 @@ def output_progress(count, total, status='', bar_len=60):
     sys.stdout.flush()
 
 
-def cmr_read_in_chunks(file_object, chunk_size=1024 * 1024):
-    """Read a file in chunks using a generator. Default chunk size: 1Mb."""
-    while True:
-        data = file_object.read(chunk_size)
-        if not data:
+class ProgressThrottle(object):
+    """Limit progress redraws to one every PROGRESS_REFRESH_INTERVAL seconds."""
+
+    def __init__(self, interval=None):
+        self.interval = PROGRESS_REFRESH_INTERVAL if interval is None else interval
+        self.last_render = 0.0
+
+    def ready(self, force=False):
+        """Return `True` if the display is due for a redraw."""
+        now = time.time()
+        if not force and now - self.last_render < self.interval:
+            return False
+        self.last_render = now
+        return True
+
+
+class BufferPool(object):
+    """Reusable read buffers shared by all transfers.
+
+    Streams borrow a buffer for their lifetime and hand it back when done,
+    so a long run allocates a handful of buffers instead of a new `bytes`
+    object for every chunk read.
+    """
+
+    def __init__(self, buffer_size=1024 * 1024, max_idle=16):
+        self.buffer_size = buffer_size
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(buffer)
+
+
+_buffer_pool = BufferPool()
+
+
+def cmr_readinto_chunks(file_object, limit=None, buffer_pool=None):
+    """Read a file in chunks into a pooled buffer using a generator.
+
+    Yields memoryviews of one reused buffer, so each chunk is only valid
+    until the next one is requested; consumers must copy what they keep.
+    Stops after `limit` bytes if given. Falls back to read() for file
+    objects without readinto().
+    """
+    pool = buffer_pool if buffer_pool is not None else _buffer_pool
+    buffer = pool.acquire()
+    view = memoryview(buffer)
+    readinto = getattr(file_object, 'readinto', None)
+    remaining = limit
+    try:
+        while remaining is None or remaining > 0:
+            target = view if remaining is None else view[:remaining]
+            if readinto is not None:
+                count = readinto(target)
+            else:
+                data = file_object.read(len(target))
+                count = len(data)
+                target[:count] = data
+            if not count:
+                break
+            if remaining is not None:
+                remaining -= count
+            yield view[:count]
+    finally:
+        pool.release(buffer)
+
+
+class ChecksumConsumer(object):
+    """Stream consumer that computes a checksum of everything written to it."""
+
+    def __init__(self, algorithm=MANIFEST_CHECKSUM):
+        self.hasher = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hasher.update(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class DecompressConsumer(object):
+    """Stream consumer that decompresses gzip/zlib or bzip2 data into `target`.
+
+    `target` is any other consumer, e.g. an open file or an io.BytesIO.
+    Call flush() after the last chunk to write out any buffered output.
+    """
+
+    def __init__(self, target, method='gzip'):
+        self.target = target
+        if method == 'bzip2':
+            self.decompressor = bz2.BZ2Decompressor()
+        else:
+            # Accept both gzip and zlib headers.
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    def write(self, data):
+        self.target.write(self.decompressor.decompress(data))
+
+    def flush(self):
+        if hasattr(self.decompressor, 'flush'):
+            self.target.write(self.decompressor.flush())
+
+
+class KeepAliveHTTPResponse(http_client.HTTPResponse):
+    """HTTP response that returns its connection to the pool when fully read.
+
+    A response closed before its body has been read to the end leaves unread
+    data on the socket, so its connection is discarded instead.
+    """
+    _pool = None
+    _pool_key = None
+    _pool_conn = None
+    _closing = False
+
+    def close(self):
+        self._closing = True
+        http_client.HTTPResponse.close(self)
+
+    def _close_conn(self):
+        http_client.HTTPResponse._close_conn(self)
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            reusable = not (self._closing or self.will_close)
+            pool.release(self._pool_key, self._pool_conn, reusable)
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections, keyed by connection class and host."""
+
+    def __init__(self, max_idle_per_host=MAX_CONNECTIONS_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def release(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                connections = self._idle.setdefault(key, [])
+                if len(connections) < self.max_idle_per_host:
+                    connections.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class KeepAliveMixin(object):
+    """Open requests over pooled persistent connections instead of one per request."""
+
+    def _keepalive_open(self, connection_class, req, **kwargs):
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+        if getattr(req, '_tunnel_host', None):
+            # Leave proxied requests to the standard handler.
+            return self.do_open(connection_class, req, **kwargs)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = (connection_class, host)
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if conn is None:
+                conn = connection_class(host, timeout=req.timeout, **kwargs)
+            conn.response_class = KeepAliveHTTPResponse
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers)
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:
+                    # The server dropped the idle connection; try a fresh one.
+                    continue
+                raise URLError(e)
             break
-        yield data
 
+        response._pool = self.pool
+        response._pool_key = key
+        response._pool_conn = conn
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, HTTPHandler):
+
+    def __init__(self, pool):
+        HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._keepalive_open(http_client.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, HTTPSHandler):
+
+    def __init__(self, pool, context=None):
+        HTTPSHandler.__init__(self, context=context)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self._keepalive_open(http_client.HTTPSConnection, req,
+                                    context=self._context)
+
+
+class TimedRedirectHandler(HTTPRedirectHandler):
+    """Follow redirects as usual, noting when the last one was taken in `timing`."""
+
+    def __init__(self, timing):
+        self.timing = timing
 
-def get_login_response(url, credentials, token):
-    opener = build_opener(HTTPCookieProcessor())
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.timing.last_redirect = time.time()
+        return HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+
+
+class URSSession(object):
+    """Long-lived Earthdata Login session shared by all downloads.
+
+    Keeps one cookie jar for the process, optionally persisted to
+    `cookie_jar` between runs, and reuses keep-alive connections. Once the
+    data host has issued its login cookie, later requests go straight to the
+    data instead of through the Earthdata Login redirects.
+
+    Responses from open() carry `ttfb`, the seconds until the response
+    headers arrived, and `redirect_time`, the part of that spent on redirects
+    and logging in before the final request.
+    """
+
+    def __init__(self, credentials=None, token=None, cookie_jar=None):
+        self.credentials = credentials
+        self.token = token
+        self.cookie_jar_path = cookie_jar or None
+        self.cookies = MozillaCookieJar(self.cookie_jar_path)
+        if self.cookie_jar_path and os.path.exists(self.cookie_jar_path):
+            try:
+                # Expired cookies are dropped while loading.
+                self.cookies.load()
+            except (LoadError, IOError):
+                pass
+        self.pool = ConnectionPool()
+        self._timing = threading.local()
+        handlers = [HTTPCookieProcessor(self.cookies), TimedRedirectHandler(self._timing)]
+        if sys.version_info[0] >= 3:
+            handlers += [KeepAliveHTTPHandler(self.pool),
+                         KeepAliveHTTPSHandler(self.pool)]
+        self.opener = build_opener(*handlers)
+        self._save_lock = threading.Lock()
+
+    def open(self, url, headers=None):
+        """Open `url`, logging in to Earthdata only when the data host asks for it."""
+        time_initial = time.time()
+        self._timing.last_redirect = None
+        response = self._open(url, headers)
+        last_redirect = self._timing.last_redirect
+        response.ttfb = time.time() - time_initial
+        response.redirect_time = last_redirect - time_initial if last_redirect else 0.0
+        return response
+
+    def _open(self, url, headers):
+        req = Request(url, headers=headers or {})
+        if self.token:
+            req.add_header('Authorization', 'Bearer {0}'.format(self.token))
+            return self.opener.open(req)
+        if not self.credentials:
+            return self.opener.open(req)
 
-    req = Request(url)
-    if token:
-        req.add_header('Authorization', 'Bearer {0}'.format(token))
-    elif credentials:
         try:
-            response = opener.open(req)
-            # We have a redirect URL - try again with authorization.
+            response = self.opener.open(req)
+            if urlparse(response.url).hostname != urlparse(URS_URL).hostname:
+                # Our cookies were accepted; no login needed.
+                return response
+            # We were redirected to the login page - try again with authorization.
+            response.close()
             url = response.url
-        except HTTPError:
+        except HTTPError as e:
             # No redirect - just try again with authorization.
-            pass
-        except Exception as e:
-            print('Error{0}: {1}'.format(type(e), str(e)))
-            sys.exit(1)
+            e.close()
+
+        req = Request(url, headers=headers or {})
+        req.add_header('Authorization', 'Basic {0}'.format(self.credentials))
+        response = self.opener.open(req)
+        self.save()
+        return response
+
+    def save(self):
+        """Write persistent cookies to the cookie jar file, if one is configured."""
+        if not self.cookie_jar_path:
+            return
+        with self._save_lock:
+            self.cookies.clear_expired_cookies()
+            self.cookies.save()
+            os.chmod(self.cookie_jar_path, 0o600)
+
+    def close(self):
+        self.save()
+        self.pool.close()
+
+
+_urs_session = None
+_urs_session_lock = threading.Lock()
+
+
+def get_urs_session(credentials, token, cookie_jar=None):
+    """Return the process-wide URSSession for the given credentials."""
+    global _urs_session
+    with _urs_session_lock:
+        session = _urs_session
+        if (session is None or session.credentials != credentials
+                or session.token != token
+                or session.cookie_jar_path != (cookie_jar or None)):
+            session = _urs_session = URSSession(credentials, token, cookie_jar)
+        return session
+
 
-        req = Request(url)
-        req.add_header('Authorization', 'Basic {0}'.format(credentials))
+def get_login_response(url, credentials, token, session=None, headers=None):
+    """Open `url` through the Earthdata Login session.
+
+    Raises AuthenticationError if the credentials are rejected; other HTTP
+    and network errors are raised unchanged so that callers can retry them.
+    """
+    if session is None:
+        session = get_urs_session(credentials, token)
 
     try:
-        response = opener.open(req)
+        response = session.open(url, headers=headers)
     except HTTPError as e:
         err = 'HTTP error {0}, {1}'.format(e.code, e.reason)
-        if 'Unauthorized' in e.reason:
+        if 'Unauthorized' in str(e.reason):
             if token:
                 err += ': Check your bearer token'
             else:
                 err += ': Check your username and password'
-            print(err)
-            sys.exit(1)
+            e.close()
+            raise AuthenticationError(err)
         raise
-    except Exception as e:
-        print('Error{0}: {1}'.format(type(e), str(e)))
-        sys.exit(1)
 
     return response
 
 
-def cmr_download(urls, force=False, quiet=False):
-    """Download files from list of urls."""
-    if not urls:
+def s3_url_for(url):
+    """Return the s3:// form of a protected HTTPS data link, or None."""
+    parts = urlparse(url)
+    if '{0}://{1}'.format(parts.scheme, parts.netloc) != S3_PROTECTED_URL:
+        return None
+    bucket, _, key = parts.path.lstrip('/').partition('/')
+    if not bucket or not key or bucket == 's3credentials':
+        return None
+    return 's3://{0}/{1}'.format(bucket, key)
+
+
+def sign_s3_request(url, headers, access_key, secret_key, region, session_token=None,
+                    now=None, payload_hash='UNSIGNED-PAYLOAD'):
+    """Add AWS Signature Version 4 headers for a GET of `url` to `headers`."""
+    now = now or datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    datestamp = amz_date[:8]
+    parts = urlparse(url)
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+    if session_token:
+        headers['x-amz-security-token'] = session_token
+
+    signed = dict((name.lower(), str(value).strip()) for name, value in headers.items()
+                  if name.lower() == 'range' or name.lower().startswith('x-amz-'))
+    signed['host'] = parts.netloc
+    signed_headers = ';'.join(sorted(signed))
+    canonical_request = '\n'.join([
+        'GET', parts.path or '/', parts.query,
+        ''.join('{0}:{1}\n'.format(name, signed[name]) for name in sorted(signed)),
+        signed_headers, payload_hash])
+    scope = '{0}/{1}/s3/aws4_request'.format(datestamp, region)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (datestamp, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = ('AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, '
+                                'Signature={3}'.format(access_key, scope, signed_headers,
+                                                       signature))
+    return headers
+
+
+class S3Transport(object):
+    """Fetch protected data straight from its S3 bucket with temporary credentials.
+
+    Credentials come from `credentials_url` (S3_CREDENTIALS_URL by default)
+    through the Earthdata Login `session`, and are fetched again shortly before they expire or when S3
+    rejects them. Requests are signed with AWS Signature Version 4 and sent
+    over the session's keep-alive connections, to `endpoint_url` (path-style)
+    if given or to the regional S3 endpoint otherwise. If the credentials
+    cannot be obtained, S3 refuses them or the S3 endpoint cannot be reached
+    (as from outside its region), the transport disables itself and open()
+    raises S3AccessError so callers can fall back to HTTPS.
+    """
+
+    def __init__(self, session, credentials_url=None, region=S3_REGION,
+                 endpoint_url=S3_ENDPOINT_URL, segments=S3_SEGMENTS,
+                 segment_threshold=S3_SEGMENT_THRESHOLD):
+        self.session = session
+        self.credentials_url = credentials_url or S3_CREDENTIALS_URL
+        self.region = region
+        self.endpoint_url = (endpoint_url or '').rstrip('/')
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.enabled = True
+        self.disabled_reason = None
+        self._credentials = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def disable(self, reason):
+        with self._lock:
+            if self.enabled:
+                self.enabled = False
+                self.disabled_reason = reason
+
+    def _fetch_credentials(self):
+        response = self.session.open(self.credentials_url)
+        try:
+            credentials = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        expires = time.time() + 60 * 60
+        expiration = credentials.get('expiration', '')
+        try:
+            expiration = datetime.strptime(expiration[:19], '%Y-%m-%d %H:%M:%S')
+            expires = time.time() + (expiration - datetime.utcnow()).total_seconds()
+        except ValueError:
+            pass
+        return credentials, expires
+
+    def credentials(self, refresh=False):
+        """Return the current temporary credentials, fetching new ones when needed."""
+        with self._lock:
+            if (refresh or self._credentials is None
+                    or time.time() > self._expires - S3_CREDENTIALS_REFRESH_MARGIN):
+                try:
+                    self._credentials, self._expires = self._fetch_credentials()
+                except (HTTPError, URLError, ValueError, KeyError) + NETWORK_ERRORS as e:
+                    self.enabled = False
+                    self.disabled_reason = 'could not get S3 credentials: {0}'.format(e)
+                    raise S3AccessError(self.disabled_reason)
+            return self._credentials
+
+    def http_url(self, s3_url):
+        bucket, _, key = s3_url[len('s3://'):].partition('/')
+        key = quote(key, safe='/~')
+        if self.endpoint_url:
+            return '{0}/{1}/{2}'.format(self.endpoint_url, bucket, key)
+        return 'https://{0}.s3.{1}.amazonaws.com/{2}'.format(bucket, self.region, key)
+
+    def open(self, s3_url, headers=None):
+        """GET `s3_url`, returning a response like URSSession.open()."""
+        if not self.enabled:
+            raise S3AccessError(self.disabled_reason)
+        url = self.http_url(s3_url)
+        headers = dict(headers or {})
+        validator = headers.pop('If-Range', None)
+        if validator:
+            # S3 has no If-Range; a mismatched If-Match/If-Unmodified-Since
+            # answers 412 instead of the whole object.
+            if validator.startswith('"'):
+                headers['If-Match'] = validator
+            else:
+                headers['If-Unmodified-Since'] = validator
+        time_initial = time.time()
+        for refresh in (False, True):
+            credentials = self.credentials(refresh=refresh)
+            signed_headers = sign_s3_request(url, dict(headers),
+                                             credentials['accessKeyId'],
+                                             credentials['secretAccessKey'], self.region,
+                                             session_token=credentials.get('sessionToken'))
+            try:
+                response = self.session.opener.open(Request(url, headers=signed_headers))
+            except HTTPError as e:
+                if e.code != 403:
+                    raise
+                e.close()
+                if not refresh:
+                    # The credentials may have expired early; try fresh ones once.
+                    continue
+                self.disable('S3 refused access (HTTP 403)')
+                raise S3AccessError(self.disabled_reason)
+            except (URLError,) + NETWORK_ERRORS as e:
+                self.disable('could not reach S3: {0}'.format(getattr(e, 'reason', e)))
+                raise S3AccessError(self.disabled_reason)
+            response.ttfb = time.time() - time_initial
+            response.redirect_time = 0.0
+            response.transport = 's3'
+            return response
+
+
+class DownloadProgress(object):
+    """Aggregate progress display shared by concurrent download workers.
+
+    Replaces the per-file progress bar with a single bar that counts finished
+    files and reports the combined transfer speed of all workers. With a
+    `file_count` of None (urls streamed from a search) only the count of
+    finished files is shown.
+    """
+
+    def __init__(self, file_count, quiet=False):
+        self.file_count = file_count
+        self.files_done = 0
+        self.bytes_read = 0
+        self.quiet = quiet
+        self.time_initial = time.time()
+        self._throttle = ProgressThrottle()
+        self._lock = threading.Lock()
+
+    def _render(self, force=False):
+        if self.quiet or not self._throttle.ready(force):
+            return
+        time_elapsed = time.time() - self.time_initial
+        speed = get_speed(time_elapsed, self.bytes_read)
+        if self.file_count is None:
+            # Streaming from a search: the number of files is not known yet.
+            fmt = '  {0} files  {1}   '.format(self.files_done, speed)
+            sys.stdout.write('\r' + fmt)
+            sys.stdout.flush()
+            return
+        status = '{0}/{1} files  {2}'.format(self.files_done, self.file_count, speed)
+        output_progress(self.files_done, self.file_count, status=status)
+
+    def update(self, byte_count):
+        with self._lock:
+            self.bytes_read += byte_count
+            self._render()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+            self._render(force=self.files_done == self.file_count)
+
+    def message(self, text):
+        with self._lock:
+            if not self.quiet:
+                print()
+                print(text)
+                self._render(force=True)
+
+    def close(self):
+        if not self.quiet:
+            print()
+
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def get_host_semaphore(url):
+    """Return the semaphore bounding concurrent downloads from the url's host."""
+    host = urlparse(url).hostname
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _host_semaphores[host]
+
+
+def parse_content_range(value):
+    """Return the total length from a `Content-Range: bytes a-b/total` header."""
+    try:
+        return int(value.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def replace_file(src, dst):
+    """Atomically rename `src` to `dst`, replacing `dst` if it exists."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def response_validator(response):
+    """Return the strong ETag of `response`, or its Last-Modified date, for If-Range."""
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def read_part_validator(part_filename):
+    """Return the validator saved when `part_filename` was started, or None."""
+    try:
+        with open(part_filename + '.validator') as validator_file:
+            return validator_file.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def save_part_validator(part_filename, validator):
+    """Remember the validator of the response `part_filename` is being written from."""
+    if validator:
+        with open(part_filename + '.validator', 'w') as validator_file:
+            validator_file.write(validator)
+    elif os.path.exists(part_filename + '.validator'):
+        os.remove(part_filename + '.validator')
+
+
+def remove_part(part_filename):
+    """Remove a .part file, if any, and its saved validator."""
+    for name in (part_filename, part_filename + '.validator'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def write_at(fd, data, offset, lock=None):
+    """Write `data` at `offset` in the file open as `fd` without moving a shared file pointer."""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
         return
+    # Platforms without pwrite (Windows): serialise seek + write.
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+class GranuleManifest(object):
+    """SQLite record of downloaded files, keyed by filename.
+
+    Stores the url, size, CMR `updated` time and checksum of each file so
+    that a sync can tell unchanged files apart without any network requests.
+    A relative `path` is taken relative to the download `directory`, and
+    files are keyed by their path relative to the manifest, so the same
+    manifest is found and matched whatever the current directory is.
+    """
+
+    def __init__(self, path=MANIFEST_FILE, directory=''):
+        self.path = os.path.abspath(os.path.join(directory, path))
+        self.root = os.path.dirname(self.path)
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS granules '
+                       '(filename TEXT PRIMARY KEY, url TEXT, size INTEGER, updated TEXT, '
+                       'checksum_type TEXT, checksum TEXT, downloaded REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+    def get(self, filename):
+        """Return the recorded entry for `filename` as a dict, or None."""
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT url, size, updated, checksum_type, checksum '
+                             'FROM granules WHERE filename = ?',
+                             (self._key(filename),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('url', 'size', 'updated', 'checksum_type', 'checksum'), row))
+
+    def record(self, filename, url, size, updated, checksum):
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (self._key(filename), url, size, updated, MANIFEST_CHECKSUM, checksum,
+                        time.time()))
+
+    def is_unchanged(self, filename, url, updated):
+        """Return `True` if `filename` is on disk exactly as recorded for this CMR granule."""
+        entry = self.get(filename)
+        if entry is None or entry['url'] != url or entry['updated'] != updated:
+            return False
+        try:
+            return os.path.getsize(filename) == entry['size']
+        except OSError:
+            return False
+
+
+def file_checksum(filename, algorithm=MANIFEST_CHECKSUM, consumer=None):
+    """Return the hex digest of a local file, or feed it into `consumer` if given."""
+    checksum = consumer if consumer is not None else ChecksumConsumer(algorithm)
+    with open(filename, 'rb') as in_file:
+        for data in cmr_readinto_chunks(in_file):
+            checksum.write(data)
+    return checksum.hexdigest()
+
+
+def cmr_stream_response(response, consumers, offset=0, length=None, quiet=False,
+                        progress=None):
+    """Feed the body of `response` to each of `consumers` and return the bytes read.
 
-    url_count = len(urls)
+    A consumer is anything with a write() method: an open file, an
+    io.BytesIO, a ChecksumConsumer, a DecompressConsumer, ... Chunks are
+    memoryviews of a pooled buffer (see cmr_readinto_chunks). `offset` is the
+    number of bytes of a `length`-byte file that were fetched earlier and is
+    only used for the progress display.
+    """
+    read_count = 0
+    time_initial = time.time()
+    throttle = ProgressThrottle()
+    for data in cmr_readinto_chunks(response):
+        for consumer in consumers:
+            consumer.write(data)
+        read_count += len(data)
+        if progress is not None:
+            progress.update(len(data))
+        elif not quiet and length and throttle.ready(offset + read_count >= length):
+            time_elapsed = time.time() - time_initial
+            download_speed = get_speed(time_elapsed, read_count)
+            output_progress(offset + read_count, length, status=download_speed)
+    return read_count
+
+
+def cmr_stream(url, consumers, filename=None, credentials=None, token=None,
+               session=None, quiet=True):
+    """Download `url` straight into `consumers`, optionally also writing it to `filename`.
+
+    E.g. to open a granule with h5py without writing it to disk:
+
+        data = io.BytesIO()
+        cmr_stream(url, [data], credentials=credentials)
+        h5py.File(data, 'r')
+
+    Unlike cmr_download_file there is no retry or resume, since consumers
+    cannot take back data they have already seen. Returns the bytes read.
+    """
+    response = get_login_response(url, credentials, token, session=session)
+    length = response.headers.get('content-length')
+    length = int(length) if length is not None else None
+    out_file = open(filename, 'wb') if filename else None
+    try:
+        all_consumers = list(consumers) + ([out_file] if out_file is not None else [])
+        read_count = cmr_stream_response(response, all_consumers, length=length, quiet=quiet)
+    finally:
+        response.close()
+        if out_file is not None:
+            out_file.close()
+    for consumer in consumers:
+        if hasattr(consumer, 'flush'):
+            consumer.flush()
+    if length is not None and read_count != length:
+        raise http_client.IncompleteRead(b'', length - read_count)
     if not quiet:
-        print('Downloading {0} files...'.format(url_count))
-    credentials = None
-    token = None
+        print()
+    return read_count
 
-    for index, url in enumerate(urls, start=1):
-        if not credentials and not token:
-            p = urlparse(url)
-            if p.scheme == 'https':
-                credentials, token = get_login_credentials()
 
-        filename = url.split('/')[-1]
-        if not quiet:
-            print('{0}/{1}: {2}'.format(str(index).zfill(len(str(url_count))),
-                                        url_count, filename))
+def cmr_download_stream(response, filename, offset, length, quiet=False,
+                        progress=None, checksum=None):
+    """Append the body of `response` to `filename`, which holds `offset` bytes so far.
 
-        for download_attempt_number in range(1, FILE_DOWNLOAD_MAX_RETRIES + 1):
-            if not quiet and download_attempt_number > 1:
-                print('Retrying download of {0}'.format(url))
+    If `checksum` (a ChecksumConsumer) is given it is fed each chunk as it
+    is written. Returns the number of bytes written.
+    """
+    with open(filename, 'ab' if offset else 'wb') as out_file:
+        consumers = [out_file] if checksum is None else [out_file, checksum]
+        read_count = cmr_stream_response(response, consumers, offset=offset, length=length,
+                                         quiet=quiet, progress=progress)
+    if offset + read_count != length:
+        raise http_client.IncompleteRead(b'', length - offset - read_count)
+    return read_count
+
+
+def cmr_download_segmented(url, response, length, filename, credentials, token,
+                           segments, quiet=False, progress=None, session=None,
+                           open_url=None, stats=None):
+    """Fetch `url` as `segments` byte ranges in parallel into `filename`.
+
+    `response` is an already open response for the whole file; it is used for
+    the first range so that segment costs no extra request. The output file
+    is preallocated to `length` bytes and each segment writes its range in
+    place. Each segment retries from where it stopped up to
+    FILE_DOWNLOAD_MAX_RETRIES times. Ranges are requested with `open_url`
+    (called with the request headers) if given, or with get_login_response.
+    The number of segment retries is added to `stats['retries']` if `stats`
+    (a dict) is given, whether or not the download succeeds.
+
+    The download only succeeds if every segment has written its whole range;
+    since the file is preallocated its size proves nothing. Any error that
+    ends a segment, retried or not, fails the download and removes the file.
+    """
+    segment_size = int(math.ceil(length / float(segments)))
+    ranges = [(start, min(start + segment_size, length))
+              for start in range(0, length, segment_size)]
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    lock = threading.Lock()
+    errors = []
+    # Start offsets of the segments that have written all of their range
+    done = set()
+    state = {'read_count': 0}
+    time_initial = time.time()
+    throttle = ProgressThrottle()
+
+    def report(byte_count):
+        if progress is not None:
+            progress.update(byte_count)
+        elif not quiet:
+            with lock:
+                state['read_count'] += byte_count
+                if not throttle.ready(state['read_count'] >= length):
+                    return
+                time_elapsed = time.time() - time_initial
+                download_speed = get_speed(time_elapsed, state['read_count'])
+                output_progress(state['read_count'], length, status=download_speed)
+
+    def fetch(start, end, first_response=None):
+        pos = start
+        attempt = 0
+        while pos < end:
+            if errors:
+                # Another segment has failed the download; stop fetching.
+                if first_response is not None:
+                    first_response.close()
+                return
             try:
-                response = get_login_response(url, credentials, token)
-                length = int(response.headers['content-length'])
+                if first_response is not None:
+                    segment_response, first_response = first_response, None
+                else:
+                    headers = {'Range': 'bytes={0}-{1}'.format(pos, end - 1)}
+                    if open_url is not None:
+                        segment_response = open_url(headers)
+                    else:
+                        segment_response = get_login_response(url, credentials, token,
+                                                              session=session, headers=headers)
+                    if segment_response.getcode() != 206:
+                        segment_response.close()
+                        raise URLError('server ignored the Range request')
                 try:
-                    if not force and length == os.path.getsize(filename):
-                        if not quiet:
+                    for data in cmr_readinto_chunks(segment_response, limit=end - pos):
+                        write_at(fd, data, pos, lock)
+                        pos += len(data)
+                        report(len(data))
+                finally:
+                    segment_response.close()
+                if pos < end:
+                    raise http_client.IncompleteRead(b'', end - pos)
+            except AuthenticationError as e:
+                errors.append(e)
+                return
+            except (HTTPError, URLError) + NETWORK_ERRORS as e:
+                attempt += 1
+                if attempt >= FILE_DOWNLOAD_MAX_RETRIES:
+                    errors.append(e)
+                    return
+                if stats is not None:
+                    with lock:
+                        stats['retries'] = stats.get('retries', 0) + 1
+            except Exception as e:
+                # E.g. ssl.SSLError while reading, or ENOSPC/EIO from pwrite
+                errors.append(e)
+                return
+        with lock:
+            done.add(start)
+
+    try:
+        os.ftruncate(fd, length)
+        threads = [threading.Thread(target=fetch, args=(start, end, response if start == 0 else None))
+                   for start, end in ranges]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    finally:
+        os.close(fd)
+
+    if errors:
+        os.remove(filename)
+        raise errors[0]
+    missing = [(start, end) for start, end in ranges if start not in done]
+    if missing:
+        os.remove(filename)
+        raise http_client.IncompleteRead(b'', sum(end - start for start, end in missing))
+    return length
+
+
+class DownloadResult(object):
+    """Outcome of one cmr_download_file call.
+
+    `status` is one of 'downloaded', 'skipped' (already present), 'unchanged'
+    (skipped by --sync) or 'failed'. `bytes` counts the data fetched by the
+    attempt that completed the file (a resumed download counts only the part
+    it fetched), `retries` the attempts after the first, including retried
+    byte ranges of a segmented download, and `error` the last error message
+    of a failed download. `ttfb` and `redirect_time` are those of the last
+    request made for the file (see URSSession), or None if no request was
+    needed, and `transport` is 'https' or 's3'.
+    """
+
+    def __init__(self, url, filename, status, bytes=0, duration=0.0, retries=0, error=None,
+                 ttfb=None, redirect_time=None, transport=None):
+        self.url = url
+        self.filename = filename
+        self.status = status
+        self.bytes = bytes
+        self.duration = duration
+        self.retries = retries
+        self.error = error
+        self.ttfb = ttfb
+        self.redirect_time = redirect_time
+        self.transport = transport
+
+    @property
+    def ok(self):
+        return self.status != 'failed'
+
+    @property
+    def host(self):
+        return urlparse(self.url).hostname
+
+    @property
+    def throughput(self):
+        """Bytes per second over the whole call, including waiting and retries."""
+        return self.bytes / self.duration if self.duration > 0 else None
+
+    def as_dict(self):
+        return dict(url=self.url, filename=self.filename, host=self.host, status=self.status,
+                    bytes=self.bytes, duration=self.duration, throughput=self.throughput,
+                    ttfb=self.ttfb, redirect_time=self.redirect_time,
+                    transport=self.transport, retries=self.retries, error=self.error)
+
+    def __repr__(self):
+        return 'DownloadResult({0!r}, status={1!r}, bytes={2}, retries={3})'.format(
+            self.filename, self.status, self.bytes, self.retries)
+
+
+class MetricsWriter(object):
+    """Write transfer metrics as JSON lines to `path`, or standard output for '-'.
+
+    Every file gets a record of type 'file' with the fields of
+    DownloadResult.as_dict(). start_run() and end_run() bracket a batch of
+    files, and end_run() writes a record of type 'run' with its totals.
+    Records are appended, so one file can collect metrics from many runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path == '-':
+            self._file = sys.stdout
+        else:
+            self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self.start_run()
+
+    def write(self, record):
+        record = dict(record, time=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def start_run(self):
+        with self._lock:
+            self._run_start = time.time()
+            self._run_counts = {}
+            self._run_bytes = 0
+            self._run_retries = 0
+
+    def file(self, result):
+        with self._lock:
+            self._run_counts[result.status] = self._run_counts.get(result.status, 0) + 1
+            self._run_bytes += result.bytes
+            self._run_retries += result.retries
+        self.write(dict(result.as_dict(), type='file'))
+
+    def end_run(self, workers=1, error=None):
+        with self._lock:
+            duration = time.time() - self._run_start
+            counts = dict(self._run_counts)
+            byte_count = self._run_bytes
+            retries = self._run_retries
+        file_count = sum(counts.values())
+        if error is not None:
+            status = 'error'
+        elif counts.get('failed'):
+            status = 'failed'
+        else:
+            status = 'ok'
+        self.write(dict(type='run', status=status, error=error, workers=workers,
+                        files=file_count, bytes=byte_count, retries=retries,
+                        duration=duration,
+                        throughput=byte_count / duration if duration > 0 else None,
+                        files_per_second=file_count / duration if duration > 0 else None,
+                        **dict((name, counts.get(name, 0)) for name in
+                               ('downloaded', 'skipped', 'unchanged', 'failed'))))
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+def cmr_download_file(url, credentials, token, force=False, quiet=False,
+                      progress=None, session=None,
+                      segments=SEGMENTED_DOWNLOAD_SEGMENTS,
+                      segment_threshold=SEGMENTED_DOWNLOAD_THRESHOLD,
+                      manifest=None, updated=None, sync=False, directory='', s3=None):
+    """Download a single file, retrying up to FILE_DOWNLOAD_MAX_RETRIES times.
+
+    Data is written to `<filename>.part` and renamed once the whole file has
+    arrived. A retry, or a later run, continues from the end of an existing
+    `.part` file with an HTTP Range request instead of starting over. The
+    request carries an If-Range with the ETag (or Last-Modified date) the
+    `.part` file was started from, so if the file has changed on the server
+    since, it is fetched again from the start.
+
+    Files of at least `segment_threshold` bytes are split into `segments`
+    byte ranges fetched in parallel (see cmr_download_segmented) when the
+    server accepts Range requests.
+
+    When `progress` is given, bytes are reported to the shared aggregate
+    display instead of drawing a per-file progress bar.
+
+    With a GranuleManifest as `manifest`, the file's size, CMR `updated` time
+    and checksum (computed while streaming) are recorded once it is on disk.
+    With `sync`, a file the manifest shows as unchanged is skipped without
+    any network request, and one whose CMR record has changed is downloaded
+    again.
+
+    Files are saved in `directory`, the current directory by default.
+
+    With an S3Transport as `s3`, protected HTTPS links are fetched from S3
+    instead, as S3_SEGMENTS concurrent range GETs for large files. If S3 is
+    not available the file is downloaded over HTTPS.
+
+    Returns a DownloadResult. AuthenticationError is raised, rather than
+    retried, if Earthdata Login rejects the credentials.
+    """
+    filename = os.path.join(directory, url.split('/')[-1])
+    part_filename = filename + '.part'
+    # Segmented downloads are preallocated, so their size says nothing about
+    # how much has arrived; keep them apart from resumable .part files.
+    segments_filename = filename + '.segments.part'
+    time_initial = time.time()
+    timing = {'ttfb': None, 'redirect_time': None, 'transport': None}
+    s3_url = s3_url_for(url) if s3 is not None else None
+
+    def open_url(headers=None):
+        if s3_url and s3.enabled:
+            try:
+                return s3.open(s3_url, headers=headers)
+            except S3AccessError as e:
+                log('S3 access failed, using HTTPS: {0}'.format(e))
+        return get_login_response(url, credentials, token, session=session, headers=headers)
+
+    def note_timing(response):
+        timing['ttfb'] = getattr(response, 'ttfb', None)
+        timing['redirect_time'] = getattr(response, 'redirect_time', None)
+        timing['transport'] = getattr(response, 'transport', 'https')
+
+    # Retries of byte ranges within segmented downloads, on top of whole-file attempts
+    segment_stats = {'retries': 0}
+
+    def result(status, bytes=0, retries=0, error=None):
+        return DownloadResult(url, filename, status, bytes=bytes,
+                              duration=time.time() - time_initial,
+                              retries=retries + segment_stats['retries'], error=error,
+                              **timing)
+
+    if sync and manifest is not None:
+        if manifest.is_unchanged(filename, url, updated):
+            if not quiet and progress is None:
+                print('  Unchanged since last sync, skipping')
+            return result('unchanged')
+        if manifest.get(filename) is not None:
+            # The granule has changed in CMR; replace our copy.
+            force = True
+
+    if force:
+        remove_part(part_filename)
+
+    def record(length, checksum=None):
+        if manifest is not None:
+            if checksum is None:
+                checksum = file_checksum(filename)
+            manifest.record(filename, url, length, updated, checksum)
+
+    def record_existing(length):
+        # A file found on disk is only hashed if the manifest does not
+        # already know it; otherwise its stored checksum stands.
+        if manifest is not None:
+            entry = manifest.get(filename)
+            if entry is None or entry['url'] != url or entry['size'] != length:
+                record(length)
+
+    def log(text):
+        if progress is not None:
+            progress.message(text)
+        else:
+            print(text)
+
+    error = None
+    read_count = 0
+    for download_attempt_number in range(1, FILE_DOWNLOAD_MAX_RETRIES + 1):
+        retries = download_attempt_number - 1
+        if not quiet and retries:
+            log('Retrying download of {0}'.format(url))
+        try:
+            with get_host_semaphore(url):
+                if not force and os.path.exists(filename):
+                    response = open_url()
+                    note_timing(response)
+                    length = int(response.headers['content-length'])
+                    response.close()
+                    if length == os.path.getsize(filename):
+                        record_existing(length)
+                        if not quiet and progress is None:
                             print('  File exists, skipping')
                         # We have already downloaded the file. Break out of the
                         # retry loop.
-                        break
-                except OSError:
-                    pass
-                count = 0
-                chunk_size = min(max(length, 1), 1024 * 1024)
-                max_chunks = int(math.ceil(length / chunk_size))
-                time_initial = time.time()
-                with open(filename, 'wb') as out_file:
-                    for data in cmr_read_in_chunks(response, chunk_size=chunk_size):
-                        out_file.write(data)
-                        if not quiet:
-                            count = count + 1
-                            time_elapsed = time.time() - time_initial
-                            download_speed = get_speed(time_elapsed, count * chunk_size)
-                            output_progress(count, max_chunks, status=download_speed)
-                if not quiet:
-                    print()
-                # If we get here, the download was successful and we can break
-                # out of the retry loop.
-                break
-            except HTTPError as e:
-                print('HTTP error {0}, {1}'.format(e.code, e.reason))
-            except URLError as e:
-                print('URL error: {0}'.format(e.reason))
-            except IOError:
-                raise
+                        return result('skipped', retries=retries)
+
+                offset = 0
+                headers = None
+                if os.path.exists(part_filename):
+                    offset = os.path.getsize(part_filename)
+                if offset:
+                    headers = {'Range': 'bytes={0}-'.format(offset)}
+                    validator = read_part_validator(part_filename)
+                    if validator:
+                        headers['If-Range'] = validator
+                try:
+                    response = open_url(headers)
+                except HTTPError as e:
+                    if e.code == 412:
+                        # S3 checks If-Range as a precondition (see
+                        # S3Transport.open): the file has changed since the
+                        # .part file was started.
+                        e.close()
+                        remove_part(part_filename)
+                        offset = 0
+                        response = open_url()
+                    elif e.code != 416:
+                        raise
+                    else:
+                        # Nothing left to fetch past `offset`: the .part file is
+                        # either complete or longer than the remote file.
+                        length = parse_content_range(e.headers.get('content-range'))
+                        e.close()
+                        if length != offset:
+                            remove_part(part_filename)
+                            raise
+                        response = None
+                if response is not None:
+                    note_timing(response)
+                    if offset and response.getcode() == 206:
+                        length = parse_content_range(response.headers.get('content-range'))
+                        if not quiet and progress is None:
+                            print('  Resuming at byte {0}'.format(offset))
+                    else:
+                        # The server sent the whole file, because it ignores
+                        # ranges or the file has changed; start from the beginning.
+                        offset = 0
+                        length = int(response.headers['content-length'])
+
+                if response is not None and timing['transport'] == 's3':
+                    # S3 always serves ranges; use its multipart settings.
+                    segments = max(segments, s3.segments)
+                    segment_threshold = min(segment_threshold, s3.segment_threshold)
+                if response is None:
+                    # The .part file already holds the whole file.
+                    replace_file(part_filename, filename)
+                    remove_part(part_filename)
+                    record(length)
+                elif (not offset and segments > 1 and length >= segment_threshold
+                        and response.headers.get('accept-ranges') == 'bytes'):
+                    read_count = cmr_download_segmented(url, response, length, segments_filename,
+                                                        credentials, token, segments, quiet=quiet,
+                                                        progress=progress, session=session,
+                                                        open_url=open_url, stats=segment_stats)
+                    replace_file(segments_filename, filename)
+                    # Segments arrive out of order, so hash the assembled file.
+                    record(length)
+                else:
+                    checksum = None
+                    if manifest is not None:
+                        checksum = ChecksumConsumer()
+                        if offset:
+                            file_checksum(part_filename, consumer=checksum)
+                    if not offset:
+                        save_part_validator(part_filename, response_validator(response))
+                    read_count = cmr_download_stream(response, part_filename, offset, length,
+                                                     quiet=quiet, progress=progress,
+                                                     checksum=checksum)
+                    replace_file(part_filename, filename)
+                    remove_part(part_filename)
+                    record(length, checksum.hexdigest() if checksum is not None else None)
+            if not quiet and progress is None:
+                print()
+            # If we get here, the download was successful.
+            return result('downloaded', bytes=read_count, retries=retries)
+        except HTTPError as e:
+            error = 'HTTP error {0}, {1}'.format(e.code, e.reason)
+            log(error)
+        except URLError as e:
+            error = 'URL error: {0}'.format(e.reason)
+            log(error)
+        except NETWORK_ERRORS as e:
+            # The connection dropped part way through; the next attempt
+            # resumes from the end of the .part file.
+            error = 'Connection error{0}: {1}'.format(type(e), str(e))
+            log(error)
+
+    # If we get here, none of our attempts to download the file succeeded.
+    log('failed to download file {0}.'.format(filename))
+    return result('failed', bytes=read_count, retries=FILE_DOWNLOAD_MAX_RETRIES - 1, error=error)
+
+
+def split_granule(item):
+    """Return the (url, updated) of a url string or a cmr_filter_granules dict."""
+    if isinstance(item, dict):
+        return item['url'], item.get('updated')
+    return item, None
+
+
+def cmr_download(urls, force=False, quiet=False, workers=DOWNLOAD_WORKERS,
+                 cookie_jar=URS_COOKIE_JAR, segments=SEGMENTED_DOWNLOAD_SEGMENTS,
+                 segment_threshold=SEGMENTED_DOWNLOAD_THRESHOLD, manifest=None,
+                 sync=False, directory='', metrics=None, s3=False,
+                 s3_endpoint_url=S3_ENDPOINT_URL):
+    """Download files from list of urls.
+
+    `urls` may also be any iterable, such as the generator returned by
+    cmr_search_iter; downloads then start as soon as the first url arrives.
+    Items may be file dicts from cmr_search_granules instead of urls, which
+    lets `manifest` record their CMR update time.
+
+    With `workers` > 1 the files are fetched concurrently by a pool of
+    threads, at most MAX_CONNECTIONS_PER_HOST at a time from any one host.
+    All downloads share one URSSession; pass `cookie_jar` to keep its login
+    cookies between runs. Files of at least `segment_threshold` bytes are
+    fetched as `segments` parallel byte ranges. Downloaded files are recorded
+    in `manifest` (a GranuleManifest) if given; with `sync`, files it shows as
+    unchanged are skipped without contacting the server. Per-file and per-run
+    timings are written to `metrics` (a MetricsWriter) if given. With `s3`,
+    protected files are read directly from S3 (see S3Transport), from
+    `s3_endpoint_url` if given, falling back to HTTPS.
+
+    Returns the list of urls that could not be downloaded. Use
+    NSIDCDownloadClient for per-file results.
+    """
+    url_count = len(urls) if hasattr(urls, '__len__') else None
+    urls = iter(urls)
+    try:
+        first_item = next(urls)
+    except StopIteration:
+        return []
+    urls = itertools.chain([first_item], urls)
 
-            # If this happens, none of our attempts to download the file
-            # succeeded. Print an error message and raise an error.
-            if download_attempt_number == FILE_DOWNLOAD_MAX_RETRIES:
-                print('failed to download file {0}.'.format(filename))
-                sys.exit(1)
+    if not quiet:
+        if url_count is None:
+            print('Downloading files...')
+        else:
+            print('Downloading {0} files...'.format(url_count))
+    credentials = None
+    token = None
+    if urlparse(split_granule(first_item)[0]).scheme == 'https':
+        credentials, token = get_login_credentials()
+    session = get_urs_session(credentials, token, cookie_jar)
+    options = dict(force=force, quiet=quiet, session=session, segments=segments,
+                   segment_threshold=segment_threshold, manifest=manifest, sync=sync,
+                   directory=directory,
+                   s3=S3Transport(session, endpoint_url=s3_endpoint_url) if s3 else None)
+    try:
+        results = _cmr_download_urls(urls, url_count, credentials, token, workers, options,
+                                     metrics=metrics)
+    finally:
+        session.save()
+    return [result.url for result in results if not result.ok]
 
 
-def cmr_filter_urls(search_results):
-    """Select only the desired data files from CMR response."""
+def _cmr_download_urls(urls, url_count, credentials, token, workers, options,
+                       metrics=None):
+    """Download `urls`, returning a DownloadResult for each in input order.
+
+    An AuthenticationError stops the remaining downloads and is re-raised.
+    Each result, and a summary of the run, is written to `metrics` (a
+    MetricsWriter) if given.
+    """
+    if metrics is None:
+        return _cmr_download_each(urls, url_count, credentials, token, workers, options,
+                                  lambda result: None)
+    metrics.start_run()
+    try:
+        results = _cmr_download_each(urls, url_count, credentials, token, workers, options,
+                                     metrics.file)
+    except Exception as e:
+        metrics.end_run(workers=workers, error=str(e))
+        raise
+    metrics.end_run(workers=workers)
+    return results
+
+
+def _cmr_download_each(urls, url_count, credentials, token, workers, options, on_result):
+    quiet = options['quiet']
+    if workers <= 1:
+        results = []
+        for index, item in enumerate(urls, start=1):
+            url, updated = split_granule(item)
+            if not quiet:
+                if url_count is None:
+                    print('{0}: {1}'.format(index, url.split('/')[-1]))
+                else:
+                    print('{0}/{1}: {2}'.format(str(index).zfill(len(str(url_count))),
+                                                url_count, url.split('/')[-1]))
+            time_initial = time.time()
+            try:
+                result = cmr_download_file(url, credentials, token, updated=updated, **options)
+            except AuthenticationError:
+                raise
+            except Exception as e:
+                print('Error{0}: {1}'.format(type(e), str(e)))
+                result = DownloadResult(url, url.split('/')[-1], 'failed',
+                                        duration=time.time() - time_initial, error=str(e))
+            on_result(result)
+            results.append(result)
+        return results
+
+    progress = DownloadProgress(url_count, quiet=quiet)
+    # A bounded queue keeps a streaming search from running far ahead of the
+    # downloads.
+    work = queue.Queue(maxsize=workers * 2)
+    results = []
+    errors = []
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for index, item in enumerate(urls):
+                if stop.is_set():
+                    break
+                work.put((index, split_granule(item)))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for _ in range(workers):
+                work.put(None)
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            if stop.is_set():
+                # Drain the queue so that the producer can finish.
+                continue
+            index, (url, updated) = item
+            time_initial = time.time()
+            try:
+                result = cmr_download_file(url, credentials, token, updated=updated,
+                                           progress=progress, **options)
+            except AuthenticationError as e:
+                # Every other download would fail the same way.
+                errors.append(e)
+                stop.set()
+                continue
+            except Exception as e:
+                # Keep the other workers going and report this file as failed.
+                progress.message('Error{0}: {1}'.format(type(e), str(e)))
+                result = DownloadResult(url, url.split('/')[-1], 'failed',
+                                        duration=time.time() - time_initial, error=str(e))
+            on_result(result)
+            results.append((index, result))
+            progress.file_done()
+
+    threads = [threading.Thread(target=producer)]
+    threads += [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so that KeyboardInterrupt is still delivered.
+        while thread.is_alive():
+            thread.join(0.5)
+    progress.close()
+    if errors:
+        raise errors[0]
+
+    # Report results in the original order so the output is reproducible.
+    return [result for _, result in sorted(results, key=lambda item: item[0])]
+
+
+def cmr_filter_granules(search_results):
+    """Select only the desired data files from CMR response.
+
+    Returns one dict per file with its `url` and the `updated` time of the
+    CMR granule record it belongs to.
+    """
     if 'feed' not in search_results or 'entry' not in search_results['feed']:
         return []
 
-    entries = [e['links']
-               for e in search_results['feed']['entry']
-               if 'links' in e]
-    # Flatten "entries" to a simple list of links
-    links = list(itertools.chain(*entries))
+    # Flatten the entries to a simple list of (entry, link) pairs
+    links = [(e, link)
+             for e in search_results['feed']['entry']
+             if 'links' in e
+             for link in e['links']]
 
-    urls = []
+    granules = []
     unique_filenames = set()
-    for link in links:
+    for entry, link in links:
         if 'href' not in link:
             # Exclude links with nothing to download
             continue
@@ -393,25 +1838,91 @@ def cmr_filter_urls(search_results):
             continue
         unique_filenames.add(filename)
 
-        urls.append(link['href'])
+        granules.append({'url': link['href'], 'updated': entry.get('updated')})
 
-    return urls
+    return granules
 
 
-def check_provider_for_collection(short_name, version, provider):
+def cmr_filter_urls(search_results):
+    """Select only the desired data files from CMR response."""
+    return [granule['url'] for granule in cmr_filter_granules(search_results)]
+
+
+class CMRCache(object):
+    """SQLite cache of CMR responses, keyed by query url.
+
+    A search is stored as its numbered result pages and is only served from
+    the cache once every page has been written and the search is no older
+    than `ttl` seconds. Page bodies are stored zlib-compressed.
+    """
+
+    def __init__(self, path=CMR_CACHE_FILE, ttl=CMR_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS searches '
+                       '(url TEXT PRIMARY KEY, fetched REAL, page_count INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS pages '
+                       '(url TEXT, page INTEGER, hits INTEGER, body BLOB, '
+                       'PRIMARY KEY (url, page))')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def page_count(self, url):
+        """Return the number of cached pages for `url`, or None if not cached or expired."""
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT fetched, page_count FROM searches WHERE url = ?',
+                             (url,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return row[1]
+
+    def get_page(self, url, page):
+        """Return the (hits, body) of a cached page."""
+        with closing(self._connect()) as db:
+            hits, body = db.execute('SELECT hits, body FROM pages WHERE url = ? AND page = ?',
+                                    (url, page)).fetchone()
+        return hits, zlib.decompress(body)
+
+    def start(self, url):
+        """Forget any cached pages for `url` before it is fetched again."""
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM searches WHERE url = ?', (url,))
+            db.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def add_page(self, url, page, hits, body):
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                       (url, page, hits, sqlite3.Binary(zlib.compress(body))))
+
+    def finish(self, url, page_count):
+        """Mark the search for `url` as complete so that it can be served from the cache."""
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?)',
+                       (url, time.time(), page_count))
+
+
+def check_provider_for_collection(short_name, version, provider, cache=None):
     """Return `True` if the collection is available for the given provider, otherwise `False`."""
     query_params = build_query_params_str(short_name=short_name, version=version, provider=provider)
     cmr_query_url = CMR_COLLECTIONS_URL + query_params
 
-    req = Request(cmr_query_url)
-    try:
-        # TODO: context w/ ssl stuff here?
-        response = urlopen(req)
-    except Exception as e:
-        print('Error: ' + str(e))
-        sys.exit(1)
+    if cache is not None and cache.page_count(cmr_query_url):
+        _, search_page = cache.get_page(cmr_query_url, 0)
+    else:
+        req = Request(cmr_query_url)
+        try:
+            # TODO: context w/ ssl stuff here?
+            response = urlopen(req)
+        except Exception as e:
+            raise CMRSearchError('Error: ' + str(e))
 
-    search_page = response.read()
+        search_page = response.read()
+        if cache is not None:
+            cache.start(cmr_query_url)
+            cache.add_page(cmr_query_url, 0, None, search_page)
+            cache.finish(cmr_query_url, 1)
     search_page = json.loads(search_page.decode('utf-8'))
 
     if 'feed' not in search_page or 'entry' not in search_page['feed']:
@@ -423,7 +1934,7 @@ def check_provider_for_collection(short_name, version, provider):
         return False
 
 
-def get_provider_for_collection(short_name, version):
+def get_provider_for_collection(short_name, version, cache=None):
     """Return the provider for the collection associated with the given short_name and version.
 
     Cloud-hosted data (NSIDC_CPRD) is preferred, but some datasets are still
@@ -431,77 +1942,375 @@ def get_provider_for_collection(short_name, version):
     cloud. ECS is planned to be decommissioned in July 2026.
     """
     cloud_provider = 'NSIDC_CPRD'
-    in_earthdata_cloud = check_provider_for_collection(short_name, version, cloud_provider)
+    in_earthdata_cloud = check_provider_for_collection(short_name, version, cloud_provider,
+                                                       cache=cache)
     if in_earthdata_cloud:
         return cloud_provider
 
     ecs_provider = 'NSIDC_ECS'
-    in_ecs = check_provider_for_collection(short_name, version, ecs_provider)
+    in_ecs = check_provider_for_collection(short_name, version, ecs_provider, cache=cache)
     if in_ecs:
         return ecs_provider
 
-    raise RuntimeError(
+    raise CMRSearchError(
         'Found no collection matching the given short_name ({0}) and version ({1})'.format(short_name, version)
     )
 
 
-def cmr_search(short_name, version, time_start, time_end,
-               bounding_box='', polygon='', filename_filter='', quiet=False):
-    """Perform a scrolling CMR query for files matching input criteria."""
-    provider = get_provider_for_collection(short_name=short_name, version=version)
-    cmr_query_url = build_cmr_query_url(provider=provider, short_name=short_name, version=version,
-                                        time_start=time_start, time_end=time_end,
-                                        bounding_box=bounding_box,
-                                        polygon=polygon, filename_filter=filename_filter)
-    if not quiet:
-        print('Querying for data:\n\t{0}\n'.format(cmr_query_url))
+def cmr_scroll_pages(cmr_query_url, cache=None, quiet=False):
+    """Yield (hits, files) for each result page of a scrolling CMR query.
 
+    `files` are the page's files as returned by cmr_filter_granules; `hits`
+    is only set on the first page. Paging stops after the first page without
+    any downloadable files. With a
+    CMRCache as `cache`, a complete and fresh earlier search for the same
+    query url is replayed from disk instead of querying CMR.
+    """
     cmr_paging_header = 'cmr-search-after'
     cmr_page_id = None
     ctx = ssl.create_default_context()
     ctx.check_hostname = False
     ctx.verify_mode = ssl.CERT_NONE
 
-    urls = []
-    hits = 0
+    cached_page_count = None
+    if cache is not None:
+        cached_page_count = cache.page_count(cmr_query_url)
+        if cached_page_count is None:
+            cache.start(cmr_query_url)
+        elif not quiet:
+            print('Using cached search results.')
+
+    page_number = 0
     while True:
-        req = Request(cmr_query_url)
-        if cmr_page_id:
-            req.add_header(cmr_paging_header, cmr_page_id)
+        if cached_page_count is not None:
+            page_hits, search_page = cache.get_page(cmr_query_url, page_number)
+        else:
+            req = Request(cmr_query_url)
+            if cmr_page_id:
+                req.add_header(cmr_paging_header, cmr_page_id)
+            try:
+                response = urlopen(req, context=ctx)
+            except Exception as e:
+                raise CMRSearchError('Error: ' + str(e))
+
+            # Python 2 and 3 have different case for the http headers
+            headers = {k.lower(): v for k, v in dict(response.info()).items()}
+            page_hits = int(headers['cmr-hits']) if 'cmr-hits' in headers else None
+            # If there are multiple pages, we'll get a new page ID on each request.
+            cmr_page_id = headers.get(cmr_paging_header)
+
+            search_page = response.read()
+            if cache is not None:
+                cache.add_page(cmr_query_url, page_number, page_hits, search_page)
+
+        search_page = json.loads(search_page.decode('utf-8'))
+        granule_scroll_results = cmr_filter_granules(search_page)
+        yield page_hits, granule_scroll_results
+        if not granule_scroll_results:
+            break
+        page_number += 1
+
+    if cache is not None and cached_page_count is None:
+        cache.finish(cmr_query_url, page_number + 1)
+
+
+def parse_cmr_time(value):
+    """Parse a CMR temporal bound such as '2018-10-14T00:00:00Z' or '2018-10-14'."""
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d'):
         try:
-            response = urlopen(req, context=ctx)
-        except Exception as e:
-            print('Error: ' + str(e))
-            sys.exit(1)
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    raise TemporalRangeError('Unrecognized time "{0}", expected e.g. 2018-10-14T00:00:00Z '
+                             'or 2018-10-14'.format(value))
+
+
+def check_temporal_range(time_start, time_end):
+    """Raise TemporalRangeError unless the given bounds parse and are in order.
+
+    Either bound may be empty for an open-ended search.
+    """
+    start = parse_cmr_time(time_start) if time_start else None
+    end = parse_cmr_time(time_end) if time_end else None
+    if start is not None and end is not None and end < start:
+        raise TemporalRangeError('Search ends ({0}) before it starts ({1})'.format(
+            time_end, time_start))
+    return start, end
+
+
+def split_temporal_range(time_start, time_end, shards):
+    """Split [time_start, time_end] into `shards` consecutive (start, end) windows."""
+    start, end = check_temporal_range(time_start, time_end)
+    if start is None or end is None:
+        raise TemporalRangeError('Sharded searches need both a start and an end time')
+    step = (end - start) / shards
+    bounds = [start + step * i for i in range(shards)] + [end]
+    return [(bounds[i].strftime('%Y-%m-%dT%H:%M:%SZ'),
+             bounds[i + 1].strftime('%Y-%m-%dT%H:%M:%SZ'))
+            for i in range(shards)]
+
+
+def cmr_search_granules(short_name, version, time_start, time_end,
+                        bounding_box='', polygon='', filename_filter='', quiet=False,
+                        cache=None, shards=1):
+    """Perform a scrolling CMR query, yielding matching files page by page.
+
+    Each file is a dict as returned by cmr_filter_granules. Files from each
+    page are yielded as soon as that page arrives, so a consumer such as
+    cmr_download can start work while later pages are still being fetched.
+    Only one page of results is held in memory at a time.
+
+    With `shards` > 1 the temporal range is split into that many windows
+    which are scrolled concurrently (see cmr_search_sharded); this needs both
+    a start and an end time. A malformed, reversed or open-ended (when
+    sharding) time range raises TemporalRangeError before anything is fetched.
+    """
+    check_temporal_range(time_start, time_end)
+    if shards > 1 and not (time_start and time_end):
+        raise TemporalRangeError('Sharded searches need both a start and an end time')
+    provider = get_provider_for_collection(short_name=short_name, version=version,
+                                           cache=cache)
+    if shards > 1:
+        for granule in cmr_search_sharded(provider, short_name, version, time_start,
+                                          time_end, shards, bounding_box=bounding_box,
+                                          polygon=polygon, filename_filter=filename_filter,
+                                          quiet=quiet, cache=cache):
+            yield granule
+        return
 
-        # Python 2 and 3 have different case for the http headers
-        headers = {k.lower(): v for k, v in dict(response.info()).items()}
-        if not cmr_page_id:
+    cmr_query_url = build_cmr_query_url(provider=provider, short_name=short_name, version=version,
+                                        time_start=time_start, time_end=time_end,
+                                        bounding_box=bounding_box,
+                                        polygon=polygon, filename_filter=filename_filter)
+    if not quiet:
+        print('Querying for data:\n\t{0}\n'.format(cmr_query_url))
+
+    hits = 0
+    for page_number, (page_hits, granule_scroll_results) in enumerate(
+            cmr_scroll_pages(cmr_query_url, cache=cache, quiet=quiet)):
+        if page_number == 0:
             # Number of hits is on the first result set, which will not have a
             # page id.
-            hits = int(headers['cmr-hits'])
+            hits = page_hits
             if not quiet:
                 if hits > 0:
                     print('Found {0} matches.'.format(hits))
                 else:
                     print('Found no matches.')
 
-        # If there are multiple pages, we'll get a new page ID on each request.
-        cmr_page_id = headers.get(cmr_paging_header)
-
-        search_page = response.read()
-        search_page = json.loads(search_page.decode('utf-8'))
-        url_scroll_results = cmr_filter_urls(search_page)
-        if not url_scroll_results:
-            break
+        if not granule_scroll_results:
+            continue
         if not quiet and hits > CMR_PAGE_SIZE:
             print('.', end='')
             sys.stdout.flush()
-        urls += url_scroll_results
+        for granule in granule_scroll_results:
+            yield granule
 
     if not quiet and hits > CMR_PAGE_SIZE:
         print()
-    return urls
+
+
+def cmr_search_sharded(provider, short_name, version, time_start, time_end, shards,
+                       bounding_box='', polygon='', filename_filter='', quiet=False,
+                       cache=None):
+    """Scroll a CMR query as `shards` concurrent temporal windows.
+
+    Each window is scrolled by its own thread. Results are yielded window by
+    window in time order, dropping files already seen in an earlier window
+    (granules spanning a window boundary match both), so the output is in
+    the same start_date/producer_granule_id order as an unsharded search.
+    """
+    windows = split_temporal_range(time_start, time_end, shards)
+    query_urls = [build_cmr_query_url(provider=provider, short_name=short_name, version=version,
+                                      time_start=window_start, time_end=window_end,
+                                      bounding_box=bounding_box, polygon=polygon,
+                                      filename_filter=filename_filter)
+                  for window_start, window_end in windows]
+    if not quiet:
+        print('Querying for data in {0} temporal shards:'.format(shards))
+        for cmr_query_url in query_urls:
+            print('\t{0}'.format(cmr_query_url))
+        print()
+
+    results = [queue.Queue() for _ in query_urls]
+    hits = [0] * len(query_urls)
+    errors = []
+
+    def scroll(index, cmr_query_url):
+        try:
+            for page_number, (page_hits, granules) in enumerate(
+                    cmr_scroll_pages(cmr_query_url, cache=cache, quiet=True)):
+                if page_number == 0:
+                    hits[index] = page_hits
+                results[index].put(granules)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            results[index].put(None)
+
+    threads = [threading.Thread(target=scroll, args=(index, cmr_query_url))
+               for index, cmr_query_url in enumerate(query_urls)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    unique_filenames = set()
+    for index, shard_results in enumerate(results):
+        while True:
+            granules = shard_results.get()
+            if granules is None:
+                break
+            for granule in granules:
+                filename = granule['url'].split('/')[-1]
+                if filename in unique_filenames:
+                    continue
+                unique_filenames.add(filename)
+                yield granule
+        if errors:
+            raise errors[0]
+
+    if not quiet:
+        total_hits = sum(hits)
+        if total_hits > 0:
+            print('Found {0} matches (including duplicates across shards).'.format(total_hits))
+        else:
+            print('Found no matches.')
+
+
+def cmr_search_iter(short_name, version, time_start, time_end,
+                    bounding_box='', polygon='', filename_filter='', quiet=False,
+                    cache=None, shards=1):
+    """Perform a scrolling CMR query, yielding matching file urls page by page."""
+    for granule in cmr_search_granules(short_name, version, time_start, time_end,
+                                       bounding_box=bounding_box, polygon=polygon,
+                                       filename_filter=filename_filter, quiet=quiet,
+                                       cache=cache, shards=shards):
+        yield granule['url']
+
+
+def cmr_search(short_name, version, time_start, time_end,
+               bounding_box='', polygon='', filename_filter='', quiet=False,
+               cache=None, shards=1):
+    """Perform a scrolling CMR query for files matching input criteria."""
+    return list(cmr_search_iter(short_name, version, time_start, time_end,
+                                bounding_box=bounding_box, polygon=polygon,
+                                filename_filter=filename_filter, quiet=quiet,
+                                cache=cache, shards=shards))
+
+
+class NSIDCDownloadClient(object):
+    """Search and download client for use from other Python programs.
+
+    Unlike main(), the client never prompts or exits: credentials are passed
+    in (`username`/`password` or `token`) or read from .netrc, failures raise
+    NSIDCDownloadError subclasses, and download() returns a DownloadResult
+    per file. One client keeps its Earthdata Login session, connections and
+    cookies between calls, so a long-lived client only logs in once.
+
+        with NSIDCDownloadClient(workers=8, directory='data') as client:
+            granules = client.search('ATL10', '006', time_start='2019-11-01T00:00:00Z',
+                                     time_end='2019-11-30T23:59:59Z')
+            failed = [r for r in client.download(granules) if not r.ok]
+
+    `cache` is an optional CMRCache for search results, `manifest` an
+    optional GranuleManifest, which sync() needs, and `metrics` an optional
+    MetricsWriter. With `s3`, protected files are read directly from S3 when
+    possible (see S3Transport).
+    """
+
+    def __init__(self, username=None, password=None, token=None,
+                 workers=DOWNLOAD_WORKERS, cookie_jar=URS_COOKIE_JAR,
+                 segments=SEGMENTED_DOWNLOAD_SEGMENTS,
+                 segment_threshold=SEGMENTED_DOWNLOAD_THRESHOLD,
+                 cache=None, manifest=None, directory='', quiet=True, metrics=None,
+                 s3=False, s3_endpoint_url=S3_ENDPOINT_URL):
+        self.credentials = None
+        self.token = token
+        if username and password:
+            self.credentials = encode_credentials(username, password)
+        elif username or password:
+            raise AuthenticationError('Both username and password are needed')
+        self.workers = workers
+        self.cookie_jar = cookie_jar
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.cache = cache
+        self.manifest = manifest
+        self.directory = directory
+        self.quiet = quiet
+        self.metrics = metrics
+        self.s3 = s3
+        self.s3_endpoint_url = s3_endpoint_url
+        self.session = None
+        self.s3_transport = None
+
+    def _get_session(self, url):
+        if self.session is None:
+            if (self.credentials is None and self.token is None
+                    and urlparse(url).scheme == 'https'):
+                self.credentials, self.token = get_login_credentials(interactive=False)
+            self.session = URSSession(self.credentials, self.token, self.cookie_jar)
+            if self.s3:
+                self.s3_transport = S3Transport(self.session, endpoint_url=self.s3_endpoint_url)
+        return self.session
+
+    def iter_search(self, short_name, version, time_start='', time_end='',
+                    bounding_box='', polygon='', filename_filter='', shards=1):
+        """Yield matching files, as cmr_search_granules dicts, page by page."""
+        return cmr_search_granules(short_name, version, time_start, time_end,
+                                   bounding_box=bounding_box, polygon=polygon,
+                                   filename_filter=filename_filter, quiet=self.quiet,
+                                   cache=self.cache, shards=shards)
+
+    def search(self, short_name, version, time_start='', time_end='',
+               bounding_box='', polygon='', filename_filter='', shards=1):
+        """Return the list of files matching the search criteria."""
+        return list(self.iter_search(short_name, version, time_start=time_start,
+                                     time_end=time_end, bounding_box=bounding_box,
+                                     polygon=polygon, filename_filter=filename_filter,
+                                     shards=shards))
+
+    def download(self, items, force=False, sync=False):
+        """Download `items` (urls or search results), returning their DownloadResults."""
+        url_count = len(items) if hasattr(items, '__len__') else None
+        items = iter(items)
+        try:
+            first_item = next(items)
+        except StopIteration:
+            return []
+        items = itertools.chain([first_item], items)
+
+        session = self._get_session(split_granule(first_item)[0])
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        options = dict(force=force, quiet=self.quiet, session=session,
+                       segments=self.segments, segment_threshold=self.segment_threshold,
+                       manifest=self.manifest, sync=sync, directory=self.directory,
+                       s3=self.s3_transport)
+        try:
+            return _cmr_download_urls(items, url_count, session.credentials, session.token,
+                                      self.workers, options, metrics=self.metrics)
+        finally:
+            session.save()
+
+    def sync(self, items, force=False):
+        """Download only the `items` that are new or changed since the manifest recorded them."""
+        if self.manifest is None:
+            raise ValueError('sync() needs a client created with a manifest')
+        return self.download(items, force=force, sync=True)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+            self.s3_transport = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 def main(url_list, argv=None):
@@ -513,19 +2322,70 @@ def main(url_list, argv=None):
 
     force = False
     quiet = False
-    usage = 'usage: nsidc-download_***.py [--help, -h] [--force, -f] [--quiet, -q]'
+    workers = DOWNLOAD_WORKERS
+    cookie_jar = URS_COOKIE_JAR
+    segments = SEGMENTED_DOWNLOAD_SEGMENTS
+    segment_threshold = SEGMENTED_DOWNLOAD_THRESHOLD
+    use_cache = True
+    cache_ttl = CMR_CACHE_TTL
+    manifest_file = MANIFEST_FILE
+    directory = ''
+    sync = False
+    shards = 1
+    metrics_file = METRICS_FILE
+    s3 = False
+    s3_endpoint_url = S3_ENDPOINT_URL
+    usage = ('usage: nsidc-download_***.py [--help, -h] [--force, -f] [--quiet, -q]'
+             ' [--workers=N, -w N] [--cookie-jar=FILE] [--segments=N]'
+             ' [--segment-threshold=MB] [--cache-ttl=SECONDS] [--no-cache]'
+             ' [--manifest=FILE] [--directory=DIR] [--sync] [--search-shards=N]'
+             ' [--metrics=FILE]'
+             ' [--s3] [--s3-endpoint-url=URL]')
 
     try:
-        opts, args = getopt.getopt(argv, 'hfq', ['help', 'force', 'quiet'])
-        for opt, _arg in opts:
+        opts, args = getopt.getopt(argv, 'hfqw:', ['help', 'force', 'quiet', 'workers=',
+                                                  'cookie-jar=', 'segments=',
+                                                  'segment-threshold=', 'cache-ttl=',
+                                                  'no-cache', 'manifest=', 'directory=',
+                                                  'sync',
+                                                  'search-shards=', 'metrics=', 's3',
+                                                  's3-endpoint-url='])
+        for opt, arg in opts:
             if opt in ('-f', '--force'):
                 force = True
             elif opt in ('-q', '--quiet'):
                 quiet = True
+            elif opt in ('-w', '--workers'):
+                workers = int(arg)
+            elif opt == '--cookie-jar':
+                cookie_jar = arg
+            elif opt == '--segments':
+                segments = int(arg)
+            elif opt == '--segment-threshold':
+                segment_threshold = int(float(arg) * 1024 * 1024)
+            elif opt == '--cache-ttl':
+                cache_ttl = float(arg)
+            elif opt == '--no-cache':
+                use_cache = False
+            elif opt == '--manifest':
+                manifest_file = arg
+            elif opt == '--directory':
+                directory = arg
+            elif opt == '--sync':
+                sync = True
+            elif opt == '--search-shards':
+                shards = int(arg)
+            elif opt == '--metrics':
+                metrics_file = arg
+            elif opt == '--s3':
+                s3 = True
+            elif opt == '--s3-endpoint-url':
+                s3 = True
+                s3_endpoint_url = arg
             elif opt in ('-h', '--help'):
                 print(usage)
                 sys.exit(0)
-    except getopt.GetoptError as e:
+    except (getopt.GetoptError, ValueError) as e:
         print(e.args[0])
         print(usage)
         sys.exit(1)
@@ -544,13 +2404,34 @@ def main(url_list, argv=None):
 
     try:
         if not url_list:
-            url_list = cmr_search(short_name, version, time_start, time_end,
-                                  bounding_box=bounding_box, polygon=polygon,
-                                  filename_filter=filename_filter, quiet=quiet)
-
-        cmr_download(url_list, force=force, quiet=quiet)
+            cache = CMRCache(CMR_CACHE_FILE, cache_ttl) if use_cache else None
+            # Stream search results straight into the downloader so that the
+            # first files download while later result pages are fetched.
+            url_list = cmr_search_granules(short_name, version, time_start, time_end,
+                                           bounding_box=bounding_box, polygon=polygon,
+                                           filename_filter=filename_filter, quiet=quiet,
+                                           cache=cache, shards=shards)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = GranuleManifest(manifest_file, directory) if manifest_file else None
+        metrics = MetricsWriter(metrics_file) if metrics_file else None
+        failed = cmr_download(url_list, force=force, quiet=quiet, workers=workers,
+                              cookie_jar=cookie_jar, segments=segments,
+                              segment_threshold=segment_threshold,
+                              manifest=manifest, sync=sync, directory=directory,
+                              metrics=metrics, s3=s3, s3_endpoint_url=s3_endpoint_url)
     except KeyboardInterrupt:
         quit()
+    except NSIDCDownloadError as e:
+        print(e)
+        sys.exit(1)
+
+    if failed:
+        print('Failed to download {0} files:'.format(len(failed)))
+        for url in failed:
+            print('  {0}'.format(url))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,25 +1,40 @@
 import os
 import platform
-from ftplib import FTP
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from ftplib import FTP, all_errors, error_perm
 import sys
 
 
-download_file_obj = None
-read_byte_count = None
-total_byte_count = None
+FTP_HOST = "science-pds.cryosat.esa.int"
+# Number of FTP connections downloading files at the same time.
+FTP_CONNECTIONS = 4
+# Number of times to try each file, reconnecting in between, before giving up.
+FTP_MAX_RETRIES = 3
+FTP_TIMEOUT = 60
+# Transfers read the data connection in blocks that start at FTP_MIN_BLOCK_SIZE
+# and double, up to FTP_MAX_BLOCK_SIZE, while the connection keeps them full.
+FTP_MIN_BLOCK_SIZE = 64 * 1024
+FTP_MAX_BLOCK_SIZE = 4 * 1024 * 1024
+# Minimum number of seconds between redraws of the progress bar.
+PROGRESS_REFRESH_INTERVAL = 0.25
+# Local index of the SIR_SAR_L2 archive used by ArchiveIndex to find files by
+# time without listing the server each time.
+ARCHIVE_ROOT = "SIR_SAR_L2"
+ARCHIVE_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".esa_sir_sar_l2_index.sqlite")
+ARCHIVE_FILENAME_PATTERN = re.compile(
+    r"^CS_\w{4}_SIR_SAR_2__(\d{8}T\d{6})_(\d{8}T\d{6})_\w{4}\.nc$")
+ARCHIVE_TIME_FORMAT = "%Y%m%dT%H%M%S"
 
 
 def get_padded_count(count, max_count):
     return str(count).zfill(len(str(max_count)))
 
 
-def file_byte_handler(data):
-    global download_file_obj, read_byte_count, total_byte_count
-    download_file_obj.write(data)
-    read_byte_count = read_byte_count + len(data)
-    progress_bar(read_byte_count, total_byte_count)
-
-
 def progress_bar(progress, total, prefix="", size=60, file=sys.stdout):
     if total != 0:
         x = int(size * progress / total)
@@ -28,27 +43,399 @@ def progress_bar(progress, total, prefix="", size=60, file=sys.stdout):
         file.flush()
 
 
-def download_files(user_email, esa_files):
-    global download_file_obj, read_byte_count, total_byte_count
+class DownloadProgress:
+    """Single progress view shared by all FTP connections.
+
+    The bar counts bytes of the files currently known to be in the batch;
+    the prefix shows how many files have finished.
+    """
+
+    def __init__(self, file_count, file=None, refresh_interval=PROGRESS_REFRESH_INTERVAL):
+        self.file_count = file_count
+        self.files_done = 0
+        self.total_bytes = 0
+        self.read_bytes = 0
+        self.transferred_bytes = 0
+        self.file = file or sys.stdout
+        self.refresh_interval = refresh_interval
+        self.time_initial = time.time()
+        self._last_render = 0.0
+        self._lock = threading.Lock()
+
+    def _render(self, force=False):
+        now = time.time()
+        if not force and now - self._last_render < self.refresh_interval:
+            return
+        self._last_render = now
+        elapsed = now - self.time_initial
+        speed = self.transferred_bytes / elapsed / 1e6 if elapsed > 0 else 0.0
+        prefix = "{}/{} files {:6.1f} MB/s".format(
+            get_padded_count(self.files_done, self.file_count), self.file_count, speed)
+        progress_bar(self.read_bytes, self.total_bytes, prefix=prefix, file=self.file)
+
+    def add_file(self, byte_count):
+        with self._lock:
+            self.total_bytes += byte_count
+
+    def update(self, byte_count):
+        with self._lock:
+            self.read_bytes += byte_count
+            self.transferred_bytes += byte_count
+            self._render()
+
+    def skip(self, byte_count):
+        """Count bytes already on disk as done without counting them towards the speed."""
+        with self._lock:
+            self.read_bytes += byte_count
+            self._render()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+            self._render(force=self.files_done == self.file_count)
+
+    def message(self, text):
+        with self._lock:
+            self.file.write("\n" + text + "\n")
+            self._render(force=True)
+
+
+class FTPConnection:
+    """A logged-in FTP session that reconnects when it has been dropped."""
+
+    def __init__(self, user_email, host=FTP_HOST):
+        self.user_email = user_email
+        self.host = host
+        self.ftp = None
+
+    def get(self):
+        if self.ftp is None:
+            ftp = FTP(self.host, timeout=FTP_TIMEOUT)
+            try:
+                ftp.login("anonymous", self.user_email)
+            except all_errors:
+                ftp.close()
+                raise
+            self.ftp = ftp
+        return self.ftp
+
+    def reset(self):
+        """Drop the current session; the next get() opens a new one."""
+        if self.ftp is not None:
+            self.ftp.close()
+            self.ftp = None
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except all_errors:
+                self.ftp.close()
+            self.ftp = None
+
+
+class FTPTransfer:
+    """State of one file being retrieved: where it goes and how much has arrived.
+
+    Data is read straight from the data connection into a reusable buffer
+    instead of through retrbinary callbacks. The buffer starts at
+    FTP_MIN_BLOCK_SIZE and doubles, up to FTP_MAX_BLOCK_SIZE, whenever a read
+    fills it, so fast connections are drained with few large reads.
+
+    A local file of the same size as the remote one is taken to be complete
+    and skipped. Otherwise data goes to `<local_filename>.part`, which a
+    later attempt continues with an FTP REST offset, and is renamed into
+    place once the whole file has arrived. If the server refuses REST, the
+    `.part` file is emptied and the whole file retrieved again.
+    """
+
+    def __init__(self, filename, local_filename=None):
+        self.filename = filename
+        self.local_filename = local_filename or os.path.basename(filename)
+        self.part_filename = self.local_filename + '.part'
+        self.total_byte_count = None
+        self.offset = 0
+        self.read_byte_count = 0
+        self.block_size = FTP_MIN_BLOCK_SIZE
+        self.status = None
+
+    def run(self, ftp, progress):
+        """Retrieve the file, setting `status` to 'downloaded' or 'skipped'."""
+        self.total_byte_count = ftp.size(self.filename)
+        progress.add_file(self.total_byte_count)
+        if (os.path.exists(self.local_filename)
+                and os.path.getsize(self.local_filename) == self.total_byte_count):
+            progress.skip(self.total_byte_count)
+            self.status = 'skipped'
+            return
+
+        self.offset = 0
+        self.read_byte_count = 0
+        if os.path.exists(self.part_filename):
+            self.offset = os.path.getsize(self.part_filename)
+            if self.offset > self.total_byte_count:
+                # Not a prefix of the remote file; start over.
+                os.remove(self.part_filename)
+                self.offset = 0
+        progress.skip(self.offset)
+        try:
+            with open(self.part_filename, 'ab' if self.offset else 'wb') as download_file:
+                self._receive(ftp, download_file, progress)
+        except BaseException:
+            # Take this attempt back out of the combined progress.
+            progress.add_file(-self.total_byte_count)
+            progress.skip(-self.offset)
+            progress.update(-self.read_byte_count)
+            raise
+        os.replace(self.part_filename, self.local_filename)
+        self.status = 'downloaded'
+
+    def _receive(self, ftp, download_file, progress):
+        if self.offset == self.total_byte_count:
+            # A previous attempt received everything but was not renamed.
+            return
+        ftp.voidcmd('TYPE I')
+        buffer = bytearray(FTP_MAX_BLOCK_SIZE)
+        view = memoryview(buffer)
+        try:
+            conn = ftp.transfercmd('RETR ' + self.filename, rest=self.offset or None)
+        except error_perm:
+            if not self.offset:
+                raise
+            # The server does not support REST (e.g. 502); as retrying would
+            # send it again, throw the partial data away and start over.
+            download_file.truncate(0)
+            progress.skip(-self.offset)
+            self.offset = 0
+            conn = ftp.transfercmd('RETR ' + self.filename)
+        with conn:
+            while True:
+                count = conn.recv_into(view[:self.block_size])
+                if not count:
+                    break
+                download_file.write(view[:count])
+                self.read_byte_count += count
+                progress.update(count)
+                if count == self.block_size and self.block_size < FTP_MAX_BLOCK_SIZE:
+                    self.block_size *= 2
+        ftp.voidresp()
+        if self.offset + self.read_byte_count != self.total_byte_count:
+            raise EOFError("received {} of {} bytes".format(self.offset + self.read_byte_count,
+                                                             self.total_byte_count))
+
+
+def download_file(connection, filename, progress):
+    """Retrieve `filename` over `connection` into the current directory."""
+    transfer = FTPTransfer(filename)
+    transfer.run(connection.get(), progress)
+    return transfer
+
+
+def download_files(user_email, esa_files, connections=FTP_CONNECTIONS):
+    """Download `esa_files` from the ESA science server over `connections` FTP sessions.
+
+    Each connection takes the next file from a shared queue. A file whose
+    transfer fails is retried on a fresh connection up to FTP_MAX_RETRIES
+    times, resuming where it stopped. Files already on disk at their full
+    size are skipped (see FTPTransfer). Returns the list of files that could
+    not be downloaded.
+    """
     print("About to connect to ESA science server")
-    with FTP("science-pds.cryosat.esa.int") as ftp:
+    print("Downloading {} files".format(len(esa_files)))
+    work = queue.Queue()
+    for filename in esa_files:
+        work.put(filename)
+    progress = DownloadProgress(len(esa_files))
+    failed = []
+    skipped = []
+
+    def worker():
+        connection = FTPConnection(user_email)
         try:
-            ftp.login("anonymous", user_email)
-            print("Downloading {} files".format(len(esa_files)))
-
-            for i, filename in enumerate(esa_files):
-                padded_count = get_padded_count(i + 1, len(esa_files))
-                print("{}/{}. Downloading file {}".format(padded_count, len(esa_files), os.path.basename(filename)))
-
-                with open(os.path.basename(filename), 'wb') as download_file:
-                    download_file_obj = download_file
-                    total_byte_count = ftp.size(filename)
-                    read_byte_count = 0
-                    ftp.retrbinary('RETR ' + filename, file_byte_handler, 1024)
-                print("\n")
+            while True:
+                try:
+                    filename = work.get_nowait()
+                except queue.Empty:
+                    return
+                for attempt in range(1, FTP_MAX_RETRIES + 1):
+                    try:
+                        transfer = download_file(connection, filename, progress)
+                        if transfer.status == 'skipped':
+                            skipped.append(filename)
+                        break
+                    except error_perm as e:
+                        # e.g. 550 No such file: retrying will not help.
+                        progress.message("Error downloading {}: {}".format(
+                            os.path.basename(filename), e))
+                        failed.append(filename)
+                        break
+                    except all_errors as e:
+                        connection.reset()
+                        progress.message("Error downloading {} (attempt {}/{}): {}".format(
+                            os.path.basename(filename), attempt, FTP_MAX_RETRIES, e))
+                else:
+                    failed.append(filename)
+                progress.file_done()
         finally:
-            print("Exiting FTP.")
-            ftp.quit()
+            connection.close()
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(max(1, min(connections, len(esa_files))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so that KeyboardInterrupt is still delivered.
+        while thread.is_alive():
+            thread.join(0.5)
+    print("\nExiting FTP.")
+    if skipped:
+        print("Skipped {} files that were already downloaded.".format(len(skipped)))
+    for filename in failed:
+        print("Failed to download {}".format(filename))
+    return failed
+
+
+def format_archive_time(value):
+    """Return a datetime, or an ISO 8601 / archive style time string, as YYYYMMDDTHHMMSS."""
+    if isinstance(value, datetime):
+        return value.strftime(ARCHIVE_TIME_FORMAT)
+    digits = re.sub(r"[^0-9T]", "", str(value).rstrip("Z"))
+    date, _, clock = digits.partition("T")
+    return "{}T{}".format(date[:8], (clock + "000000")[:6])
+
+
+class ArchiveIndex:
+    """Local SQLite index of the SIR_SAR_L2 files on the ESA server.
+
+    refresh() walks SIR_SAR_L2/YYYY/MM/ with MLSD (or NLST and SIZE on
+    servers without it) and records each file's size and the start and stop
+    times in its name. A month is only listed again when its directory's
+    modification time has changed since the last refresh, or on every refresh
+    if the server does not report one. query() then answers time window
+    searches from the local index alone.
+    """
+
+    def __init__(self, path=ARCHIVE_INDEX_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS months ("
+                " month TEXT PRIMARY KEY, modify TEXT, listed_at REAL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, month TEXT, size INTEGER,"
+                " start TEXT, stop TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_start ON files (start)")
+
+    @staticmethod
+    def _list(ftp, path):
+        """Return {name: facts} for `path`, using MLSD where the server has it."""
+        try:
+            return dict(ftp.mlsd(path))
+        except error_perm:
+            pass
+        entries = {}
+        for name in ftp.nlst(path):
+            name = name.rstrip("/").split("/")[-1]
+            if name in (".", ".."):
+                continue
+            entries[name] = {}
+        return entries
+
+    def _list_month(self, ftp, month):
+        rows = []
+        for name, facts in self._list(ftp, month).items():
+            match = ARCHIVE_FILENAME_PATTERN.match(name)
+            if not match or facts.get("type", "file") != "file":
+                continue
+            path = month + "/" + name
+            size = facts.get("size")
+            if size is None:
+                size = ftp.size(path)
+            rows.append((path, month, int(size), match.group(1), match.group(2)))
+        return rows
+
+    def refresh(self, ftp, time_start=None, time_end=None):
+        """Bring the index up to date for the months overlapping the time window.
+
+        Returns the number of month directories that were listed.
+        """
+        first = None
+        if time_start:
+            # A file is stored under the month it starts in, so one starting
+            # late in the previous month can still overlap the window.
+            start = format_archive_time(time_start)
+            year, month = int(start[:4]), int(start[4:6])
+            if month == 1:
+                year, month = year - 1, 13
+            first = "{:04d}{:02d}".format(year, month - 1)
+        last = format_archive_time(time_end)[:6] if time_end else None
+        with self._lock:
+            known = dict(self.db.execute("SELECT month, modify FROM months"))
+
+        listed = 0
+        for year, year_facts in sorted(self._list(ftp, ARCHIVE_ROOT).items()):
+            if not year.isdigit() or year_facts.get("type", "dir") != "dir":
+                continue
+            if (first and year < first[:4]) or (last and year > last[:4]):
+                continue
+            year_path = "{}/{}".format(ARCHIVE_ROOT, year)
+            for month, facts in sorted(self._list(ftp, year_path).items()):
+                if not month.isdigit() or facts.get("type", "dir") != "dir":
+                    continue
+                if (first and year + month < first) or (last and year + month > last):
+                    continue
+                month_path = "{}/{}".format(year_path, month)
+                modify = facts.get("modify")
+                if modify is not None and known.get(month_path) == modify:
+                    continue
+                rows = self._list_month(ftp, month_path)
+                with self._lock, self.db:
+                    self.db.execute("DELETE FROM files WHERE month = ?", (month_path,))
+                    self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", rows)
+                    self.db.execute("INSERT OR REPLACE INTO months VALUES (?, ?, ?)",
+                                    (month_path, modify, time.time()))
+                listed += 1
+        return listed
+
+    def query(self, time_start=None, time_end=None):
+        """Return [(path, size, start, stop)] of files overlapping the time window."""
+        sql = "SELECT path, size, start, stop FROM files WHERE 1"
+        params = []
+        if time_start:
+            sql += " AND stop >= ?"
+            params.append(format_archive_time(time_start))
+        if time_end:
+            sql += " AND start <= ?"
+            params.append(format_archive_time(time_end))
+        with self._lock:
+            return self.db.execute(sql + " ORDER BY start", params).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def discover_files(user_email, time_start=None, time_end=None, refresh=True,
+                   index_file=ARCHIVE_INDEX_FILE):
+    """Return the archive paths of SIR_SAR_L2 files overlapping the time window.
+
+    The paths can be passed straight to download_files. With `refresh` the
+    local index is first brought up to date for the months in the window;
+    without it the answer comes from the index alone.
+    """
+    index = ArchiveIndex(index_file)
+    try:
+        if refresh:
+            connection = FTPConnection(user_email)
+            try:
+                index.refresh(connection.get(), time_start, time_end)
+            finally:
+                connection.close()
+        return [path for path, _, _, _ in index.query(time_start, time_end)]
+    finally:
+        index.close()
 
 
 if __name__ == '__main__':
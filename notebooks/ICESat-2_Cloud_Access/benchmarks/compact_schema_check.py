@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Validates the compact ATL10 schema against full precision output.
+
+Reads synthetic ATL10-like granules (see read_atl10_benchmark.py) with
+read_atl10 and with load_icesat2_as_dataframe from the ICESat-2 MODIS
+tutorial, once with the default dtypes and once with compact=True, and:
+
+* checks that every compact column matches the full precision one, exactly
+  for times, flags, beams and coordinates and to float32 rounding for the
+  measurements;
+* writes the compact frame to Parquet, reads it back and checks the dtypes
+  and values survive the round trip;
+* reports the in-memory size of both frames.
+
+For example:
+
+    $ python compact_schema_check.py --granules=4 --segments=100000
+
+Exits with an error on the first mismatch.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'ICESat-2_MODIS_Arctic_Sea_Ice'))
+import read_atl10_benchmark as benchmark  # noqa: E402
+import tutorial_helper_functions as tutorial  # noqa: E402
+
+atl10 = benchmark.atl10
+
+# Largest relative error of rounding a float64 to float32
+FLOAT32_RELATIVE_ERROR = 2.0 ** -24
+
+
+def check_column(name, full, compact):
+    """Raises AssertionError unless the compact column is a faithful copy of the full one."""
+    full = np.asarray(full)
+    compact = np.asarray(compact)
+    if full.dtype.kind == 'M':
+        compact = compact.astype('datetime64[s]')
+    assert full.shape == compact.shape, '{0}: {1} != {2} rows'.format(name, full.shape, compact.shape)
+    if full.dtype.kind == 'f' and compact.dtype == np.float32 and full.dtype != np.float32:
+        tolerance = FLOAT32_RELATIVE_ERROR * np.abs(full)
+        error = np.abs(compact.astype(np.float64) - full)
+        assert np.all((error <= tolerance) | (np.isnan(full) & np.isnan(compact))), \
+            '{0}: float32 error {1} beyond rounding'.format(name, np.nanmax(error - tolerance))
+    else:
+        assert np.array_equal(full.astype(compact.dtype) if full.dtype.kind != 'O' else full,
+                              compact, equal_nan=compact.dtype.kind == 'f'), '{0} differs'.format(name)
+
+
+def check_frames(full, compact, delta_time=None):
+    for name in full.columns:
+        if name == 'geometry':
+            assert full.geometry.geom_equals(compact.geometry).all(), 'geometry differs'
+        elif name == 'delta_time' and delta_time is not None:
+            check_column(name, delta_time(full[name]), compact[name])
+        else:
+            check_column(name, full[name].astype(str) if full[name].dtype == object else full[name],
+                         compact[name].astype(str) if compact[name].dtype.name == 'category' else compact[name])
+
+
+def check_parquet(compact):
+    """Round trips a compact frame through Parquet and returns its size on disk."""
+    path = tempfile.mktemp(suffix='.parquet')
+    try:
+        compact.to_parquet(path)
+        back = pd.read_parquet(path)
+        size = os.path.getsize(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    for name in compact.columns:
+        assert back[name].dtype == compact[name].dtype, \
+            '{0}: {1} after Parquet, was {2}'.format(name, back[name].dtype, compact[name].dtype)
+    assert back.reset_index(drop=True).equals(compact.reset_index(drop=True)), 'Parquet round trip changed values'
+    return size
+
+
+def megabytes(df):
+    return df.memory_usage(deep=True).sum() / 1e6
+
+
+def report(name, full, compact, parquet_size):
+    print('{0:<32} {1:>10} {2:>10.1f} {3:>10.1f} {4:>8.2f}x {5:>10.1f}'.format(
+        name, len(full), megabytes(full), megabytes(compact), megabytes(full) / megabytes(compact),
+        parquet_size / 1e6))
+
+
+def check_read_atl10(urls, output):
+    full = atl10.read_atl10(urls, output=output)
+    compact = atl10.read_atl10(urls, output=output, compact=True)
+    check_frames(full, compact, delta_time=lambda values: np.asarray(values, dtype='datetime64[s]'))
+    parquet_size = check_parquet(pd.DataFrame(compact.drop(columns='geometry', errors='ignore')))
+    report('read_atl10 ' + output, full, compact, parquet_size)
+
+
+def check_tutorial(granules):
+    """load_icesat2_as_dataframe over the same granules, saved to disk as the tutorial expects."""
+    variables = ['/{0}/freeboard_segment/{1}'.format(beam, name)
+                 for beam in ('gt1l', 'gt2l', 'gt3l')
+                 for name in ('delta_time', 'latitude', 'longitude', 'beam_fb_height', 'seg_dist_x',
+                              'heights/height_segment_type')]
+    directory = tempfile.mkdtemp(prefix='compact-schema-')
+    fulls, compacts = [], []
+    try:
+        for index, data in enumerate(granules.values()):
+            path = os.path.join(directory, 'ATL10-02_{0:08d}_006_01.h5'.format(index))
+            with open(path, 'wb') as granule_file:
+                granule_file.write(data)
+            with h5py.File(path, 'a') as h5:
+                h5.attrs['identifier_product_type'] = np.bytes_('ATL10')
+            fulls.append(tutorial.load_icesat2_as_dataframe(path, {'ATL10': variables}))
+            compacts.append(tutorial.load_icesat2_as_dataframe(path, {'ATL10': variables}, compact=True))
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    full = pd.concat(fulls, ignore_index=True)
+    # concatenating categoricals with different categories falls back to object
+    compact = tutorial.compact_dataframe(pd.concat(compacts, ignore_index=True))
+    check_frames(full, compact, delta_time=lambda values: np.floor(values).astype(np.int32))
+    report('load_icesat2_as_dataframe', full, compact, check_parquet(compact))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--granules', type=int, default=2, help='number of granules')
+    parser.add_argument('--segments', type=int, default=50000,
+                        help='freeboard segments per beam in each granule')
+    args = parser.parse_args(argv)
+
+    granules = {}
+    for index in range(args.granules):
+        path = '/ATLAS/ATL10/006/ATL10-02_{0:08d}_006_01.h5'.format(index)
+        granules[path] = benchmark.make_granule(args.segments, orient=index % 2, seed=index)
+    server = benchmark.start_server(granules, 0.0)
+    urls = ['http://127.0.0.1:{0}{1}'.format(server.server_address[1], path) for path in granules]
+
+    print('{0:<32} {1:>10} {2:>10} {3:>10} {4:>9} {5:>10}'.format(
+        'frame', 'rows', 'full MB', 'compact MB', 'ratio', 'parquet MB'))
+    try:
+        for output in ('geodataframe', 'dataframe'):
+            check_read_atl10(urls, output)
+        check_tutorial(granules)
+    finally:
+        server.shutdown()
+        server.server_close()
+    print('compact schema matches full precision output')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+"""Offline benchmark for the search and download path of ATL10_V6_download_script.py.
+
+Starts four local HTTP servers standing in for Earthdata:
+
+* CMR, serving collection lookups and granule searches paged with the
+  `cmr-hits` and `cmr-search-after` headers;
+* Earthdata Login (URS), which answers the Basic-auth login by redirecting
+  back to the data host;
+* a data host that sends unauthenticated requests to URS, sets a login
+  cookie, supports Range and If-Range requests and can add latency to every response or
+  drop a share of transfers part way through. It also hands out temporary S3
+  credentials from /s3credentials;
+* an S3 endpoint serving the same granules path-style, which checks the
+  AWS Signature Version 4 `Authorization` and `x-amz-*` headers against the
+  credentials handed out, answers 403 to expired ones, honours Range,
+  If-Match and If-Unmodified-Since (412 when they do not hold) and can stop
+  answering after a number of requests, as it does outside its region.
+
+The script then searches for and downloads every granule with each of the
+requested worker counts and reports files/s, MB/s and how the time was spent
+between search, login redirects and transfer. For example:
+
+    $ python download_benchmark.py --files=200 --size=4 --latency=20 --workers=1,4,16
+    $ python download_benchmark.py --failure-rate=0.1 --json=results.jsonl
+    $ python download_benchmark.py --s3 --size=64 --workers=1,4
+
+With --s3 protected files are read from the S3 stand-in (see --s3 in the
+download script). s3_transport_check.py uses the same stand-ins to check the
+S3 transport's credential refresh, 412 restart and HTTPS fallback.
+
+Nothing leaves the machine, so results can be compared from one release of
+the download script to the next.
+"""
+import argparse
+import base64
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ATL10_V6_download_script as nsidc  # noqa: E402
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+COOKIE = 'urs_session=benchmark'
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many workers times S3_SEGMENTS connect at once; the default backlog of 5
+    # would add a SYN retransmit (about a second) to some of them.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on pooled or deliberately broken connections is
+        # part of the benchmark, not an error worth a traceback.
+        if not isinstance(sys.exc_info()[1], (ConnectionError, OSError)):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class FakeEarthdata(object):
+    """CMR, URS, data host and S3 stand-ins on four local ports.
+
+    `responses` counts the status codes sent, by (role, code).
+    expire_s3_credentials() makes S3 refuse every credential handed out so
+    far; with `s3_outage_after` set, the S3 endpoint drops every object
+    request after that many without answering.
+    """
+
+    def __init__(self, files=100, size=1024 * 1024, page_size=50, latency=0.0,
+                 failure_rate=0.0, seed=0):
+        self.files = files
+        self.size = size
+        self.page_size = page_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.version = 0
+        self.data = os.urandom(size)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {'cmr': 0, 'urs': 0, 'data': 0, 's3': 0, 'credentials': 0}
+        self.responses = collections.Counter()
+        self.s3_credentials = {}
+        self.s3_outage_after = None
+        self.servers = {}
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Replacing the data changes the ETag and Last-Modified date, as a
+        # reprocessed granule would
+        self._data = data
+        self.etag = '"{0:08x}"'.format(zlib.crc32(data) & 0xffffffff)
+        self.version += 1
+        self.last_modified = formatdate(1700000000 + 60 * self.version, usegmt=True)
+
+    def start(self):
+        for role in ('cmr', 'urs', 'data', 's3'):
+            server = QuietHTTPServer(('127.0.0.1', 0), FakeEarthdataHandler)
+            server.role = role
+            server.earthdata = self
+            self.servers[role] = server
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def url(self, role, host='127.0.0.1'):
+        return 'http://{0}:{1}'.format(host, self.servers[role].server_address[1])
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def count(self, role):
+        with self.lock:
+            self.requests[role] += 1
+
+    def record(self, role, code):
+        with self.lock:
+            self.responses[role, code] += 1
+
+    def issue_s3_credentials(self):
+        with self.lock:
+            self.requests['credentials'] += 1
+            number = self.requests['credentials']
+        expiration = datetime.utcnow() + timedelta(hours=1)
+        credentials = {'accessKeyId': 'ASIABENCHMARK{0:04d}'.format(number),
+                       'secretAccessKey': 'benchmark-secret-{0}'.format(number),
+                       'sessionToken': 'benchmark-token-{0}'.format(number),
+                       'expiration': expiration.strftime('%Y-%m-%d %H:%M:%S+00:00')}
+        with self.lock:
+            self.s3_credentials[credentials['accessKeyId']] = credentials
+        return credentials
+
+    def expire_s3_credentials(self):
+        with self.lock:
+            self.s3_credentials.clear()
+
+    def s3_available(self):
+        with self.lock:
+            return self.s3_outage_after is None or self.requests['s3'] <= self.s3_outage_after
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def granule_page(self, after):
+        entries = []
+        for index in range(after, min(after + self.page_size, self.files)):
+            name = 'ATL10-01_{0:08d}_006_01.h5'.format(index)
+            entries.append({
+                'producer_granule_id': name,
+                'updated': '2024-01-01T00:00:00.000Z',
+                'links': [{'rel': 'http://esipfed.org/ns/fedsearch/1.1/data#',
+                           'href': '{0}/ATLAS/ATL10/006/{1}'.format(self.url('data'), name)}],
+            })
+        return {'feed': {'entry': entries}}
+
+
+class FakeEarthdataHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def earthdata(self):
+        return self.server.earthdata
+
+    def do_GET(self):
+        self.earthdata.count(self.server.role)
+        if self.earthdata.latency:
+            time.sleep(self.earthdata.latency)
+        getattr(self, 'handle_' + self.server.role)()
+
+    def send_response(self, code, message=None):
+        self.earthdata.record(self.server.role, code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def send(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def redirect(self, location, headers=()):
+        self.send(302, headers=[('Location', location)] + list(headers))
+
+    def handle_cmr(self):
+        path = urlparse(self.path).path
+        if path.endswith('/collections.json'):
+            entries = [{'id': 'C0000000000-NSIDC_CPRD'}] if 'NSIDC_CPRD' in self.path else []
+            body = {'feed': {'entry': entries}}
+            self.send(200, json.dumps(body).encode('utf-8'))
+            return
+        after = int(self.headers.get('cmr-search-after') or 0)
+        body = json.dumps(self.earthdata.granule_page(after)).encode('utf-8')
+        headers = [('cmr-hits', str(self.earthdata.files))]
+        if after < self.earthdata.files:
+            headers.append(('cmr-search-after', str(after + self.earthdata.page_size)))
+        self.send(200, body, headers)
+
+    def handle_urs(self):
+        query = parse_qs(urlparse(self.path).query)
+        expected = base64.b64encode('{0}:{1}'.format(USERNAME, PASSWORD).encode('ascii'))
+        if self.headers.get('Authorization') != 'Basic ' + expected.decode('ascii'):
+            self.send(401)
+            return
+        self.redirect('{0}?code=benchmark&state={1}'.format(query['redirect_uri'][0],
+                                                            quote(query['state'][0])))
+
+    def handle_data(self):
+        url = urlparse(self.path)
+        if url.path == '/login':
+            state = parse_qs(url.query)['state'][0]
+            self.redirect(state, [('Set-Cookie', COOKIE + '; Max-Age=3600; Path=/')])
+            return
+        if COOKIE not in (self.headers.get('Cookie') or ''):
+            self.redirect('{0}/oauth/authorize?redirect_uri={1}/login&state={2}'.format(
+                self.earthdata.urs_url, self.earthdata.data_url, quote(self.path)))
+            return
+        if url.path == '/s3credentials':
+            credentials = self.earthdata.issue_s3_credentials()
+            self.send(200, json.dumps(credentials).encode('utf-8'),
+                      [('Content-Type', 'application/json')])
+            return
+
+        value = self.headers.get('Range')
+        if value and self.headers.get('If-Range') not in (None, self.earthdata.etag,
+                                                          self.earthdata.last_modified):
+            # The client's copy is of an older version; send the whole file.
+            value = None
+        self.send_object(value)
+
+    def handle_s3(self):
+        if not self.earthdata.s3_available():
+            # Hang up without answering, as an unreachable endpoint would.
+            self.close_connection = True
+            return
+        if not self.signature_valid():
+            self.send(403, b'<Error><Code>AccessDenied</Code></Error>')
+            return
+        if_match = self.headers.get('If-Match')
+        if_unmodified_since = self.headers.get('If-Unmodified-Since')
+        if ((if_match and if_match != self.earthdata.etag)
+                or (if_unmodified_since and parsedate_to_datetime(if_unmodified_since)
+                    < parsedate_to_datetime(self.earthdata.last_modified))):
+            self.send(412, b'<Error><Code>PreconditionFailed</Code></Error>')
+            return
+        self.send_object(self.headers.get('Range'))
+
+    def signature_valid(self):
+        """Check the request's SigV4 signature against the credentials handed out."""
+        authorization = self.headers.get('Authorization') or ''
+        access_key = authorization.partition('Credential=')[2].partition('/')[0]
+        with self.earthdata.lock:
+            credentials = self.earthdata.s3_credentials.get(access_key)
+        amz_date = self.headers.get('x-amz-date')
+        if credentials is None or not amz_date:
+            return False
+        if self.headers.get('x-amz-security-token') != credentials['sessionToken']:
+            return False
+        headers = dict((name.lower(), value) for name, value in self.headers.items()
+                       if name.lower() == 'range' or name.lower().startswith('x-amz-'))
+        expected = nsidc.sign_s3_request('http://{0}{1}'.format(self.headers['Host'], self.path),
+                                         headers, credentials['accessKeyId'],
+                                         credentials['secretAccessKey'], nsidc.S3_REGION,
+                                         session_token=credentials['sessionToken'],
+                                         now=datetime.strptime(amz_date, '%Y%m%dT%H%M%SZ'),
+                                         payload_hash=headers.get('x-amz-content-sha256', ''))
+        return authorization == expected['Authorization']
+
+    def send_object(self, value):
+        """Send the granule data, or the part of it named by the Range header `value`."""
+        data, etag = self.earthdata.data, self.earthdata.etag
+        start, end = 0, len(data)
+        if value:
+            first, _, last = value.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            if start >= len(data):
+                self.send(416, headers=[('Content-Range', 'bytes */{0}'.format(len(data)))])
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {0}-{1}/{2}'.format(start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.earthdata.last_modified)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if self.earthdata.should_fail():
+            # Drop the connection half way through the body.
+            self.wfile.write(data[start:start + (end - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:end])
+
+
+def point_script_at(earthdata):
+    """Redirect the download script's CMR, URS and S3 endpoints to the stand-ins.
+
+    Granule links on the data host count as protected, so with --s3 (or
+    `s3=True` on the client) they are read from the S3 stand-in, whose
+    endpoint is earthdata.url('s3').
+    """
+    # URSSession tells a login redirect from a data response by host name,
+    # so URS must not share the data host's.
+    earthdata.urs_url = earthdata.url('urs', host='localhost')
+    earthdata.data_url = earthdata.url('data')
+    nsidc.S3_PROTECTED_URL = earthdata.data_url
+    nsidc.S3_CREDENTIALS_URL = earthdata.data_url + '/s3credentials'
+    nsidc.CMR_URL = earthdata.url('cmr')
+    nsidc.URS_URL = earthdata.urs_url
+    nsidc.CMR_FILE_URL = ('{0}/search/granules.json?'
+                          '&sort_key[]=start_date&sort_key[]=producer_granule_id'
+                          '&page_size={1}'.format(nsidc.CMR_URL, earthdata.page_size))
+    nsidc.CMR_COLLECTIONS_URL = '{0}/search/collections.json?'.format(nsidc.CMR_URL)
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else 0.0
+
+
+def run_once(earthdata, workers, segments=1, segment_threshold=0, s3=False):
+    """Search and download everything once with a fresh client and directory."""
+    directory = tempfile.mkdtemp(prefix='nsidc-benchmark-')
+    try:
+        client = nsidc.NSIDCDownloadClient(USERNAME, PASSWORD, workers=workers,
+                                           segments=segments,
+                                           segment_threshold=segment_threshold,
+                                           directory=directory, s3=s3,
+                                           s3_endpoint_url=earthdata.url('s3'))
+        with client:
+            time_initial = time.time()
+            granules = client.search('ATL10', '006')
+            search_time = time.time() - time_initial
+            time_initial = time.time()
+            results = client.download(granules)
+            download_time = time.time() - time_initial
+    finally:
+        shutil.rmtree(directory)
+
+    byte_count = sum(result.bytes for result in results)
+    return {
+        'workers': workers,
+        'segments': segments,
+        's3_files': sum(1 for result in results if result.transport == 's3'),
+        'files': len(results),
+        'failed': sum(1 for result in results if not result.ok),
+        'retries': sum(result.retries for result in results),
+        'search_s': search_time,
+        'download_s': download_time,
+        'files_per_s': len(results) / download_time if download_time else 0.0,
+        'mb_per_s': byte_count / 1e6 / download_time if download_time else 0.0,
+        # Per-file means; with several workers these overlap in time.
+        'auth_s': mean(result.redirect_time for result in results),
+        'ttfb_s': mean(result.ttfb for result in results),
+        'transfer_s': mean(result.duration - (result.ttfb or 0.0) for result in results),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=100, help='number of granules')
+    parser.add_argument('--size', type=float, default=1.0, help='size of each granule in MB')
+    parser.add_argument('--page-size', type=int, default=50, help='CMR results per page')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds added to every response')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='share of transfers dropped half way (0-1)')
+    parser.add_argument('--workers', default='1,4,8',
+                        help='comma separated worker counts to compare')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='byte ranges per file (see --segments in the download script)')
+    parser.add_argument('--s3', action='store_true',
+                        help='read the granules from the S3 stand-in (see --s3 in the download script)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per worker count')
+    parser.add_argument('--json', help='append each run as a JSON line to this file')
+    args = parser.parse_args(argv)
+
+    earthdata = FakeEarthdata(files=args.files, size=int(args.size * 1024 * 1024),
+                              page_size=args.page_size, latency=args.latency / 1000.0,
+                              failure_rate=args.failure_rate).start()
+    point_script_at(earthdata)
+
+    columns = ('workers', 'files', 'failed') + (('s3_files',) if args.s3 else ()) + (
+        'retries', 'search_s', 'download_s', 'files_per_s', 'mb_per_s', 'auth_s', 'ttfb_s',
+        'transfer_s')
+    print(' '.join('{0:>11}'.format(column) for column in columns))
+    try:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            for _ in range(args.repeat):
+                row = run_once(earthdata, workers, segments=args.segments, s3=args.s3)
+                print(' '.join('{0:>11.3f}'.format(row[column]) if isinstance(row[column], float)
+                               else '{0:>11}'.format(row[column]) for column in columns))
+                if args.json:
+                    row.update(files_mb=args.size, latency_ms=args.latency,
+                               failure_rate=args.failure_rate, s3=args.s3)
+                    with open(args.json, 'a') as json_file:
+                        json_file.write(json.dumps(row, sort_keys=True) + '\n')
+    finally:
+        earthdata.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Offline benchmark for the FTP transfer path of SIR_SAR_L2_E_download_script.py.
+
+Starts a minimal local FTP server standing in for the ESA science server,
+serving a tree of SIR_SAR_L2 files, and downloads them:
+
+* the way the script used to, over one connection with retrbinary 1 KiB
+  callbacks and a progress bar redrawn for every block ("legacy");
+* with FTPTransfer over one connection;
+* with download_files over a pool of connections.
+
+Each run reports files/s and MB/s. Afterwards download_files is checked
+against half-downloaded `.part` files, once resuming them with REST and once
+with REST refused by the server, when they must be fetched again in full.
+For example:
+
+    $ python ftp_benchmark.py --files=20 --size=50 --connections=1,4,8
+    $ python ftp_benchmark.py --latency=30 --connections=4
+
+Progress output goes to /dev/null so that terminal speed does not skew the
+numbers; the cost of formatting each redraw is still measured.
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from ftplib import FTP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SIR_SAR_L2_E_download_script as esa  # noqa: E402
+
+
+class FakeFTPHandler(socketserver.StreamRequestHandler):
+    """The subset of FTP that the download script uses, in passive mode.
+
+    REST is only accepted while the server's `rest` is true; otherwise it is
+    answered 502 as on servers without restart support.
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+        self.wfile.flush()
+
+    def handle(self):
+        files = self.server.files
+        passive = None
+        offset = 0
+        self.reply('220 FTP benchmark server ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            command, _, argument = line.decode('ascii').strip().partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                self.reply('331 Send password')
+            elif command == 'PASS':
+                self.reply('230 Logged in')
+            elif command == 'TYPE':
+                self.reply('200 Type set')
+            elif command == 'SIZE':
+                if argument in files:
+                    self.reply('213 {0}'.format(len(files[argument])))
+                else:
+                    self.reply('550 No such file')
+            elif command == 'PASV':
+                passive = socket.socket()
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,{0},{1})'.format(
+                    port >> 8, port & 0xff))
+            elif command == 'REST' and self.server.rest:
+                offset = int(argument)
+                self.reply('350 Restarting at {0}'.format(offset))
+            elif command == 'RETR':
+                if argument not in files or passive is None:
+                    self.reply('550 No such file')
+                    continue
+                self.reply('150 Opening data connection')
+                conn, _ = passive.accept()
+                passive.close()
+                passive = None
+                data = files[argument][offset:]
+                offset = 0
+                with contextlib.closing(conn):
+                    conn.sendall(data)
+                self.server.count(len(data))
+                self.reply('226 Transfer complete')
+            elif command == 'QUIT':
+                self.reply('221 Goodbye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class FakeFTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files, latency=0.0, rest=True):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeFTPHandler)
+        self.files = files
+        self.latency = latency
+        self.rest = rest
+        self.sent_bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, byte_count):
+        with self.lock:
+            self.sent_bytes += byte_count
+
+
+class LocalFTPConnection(esa.FTPConnection):
+    """FTPConnection to the benchmark server instead of the ESA host."""
+
+    port = None
+
+    def get(self):
+        if self.ftp is None:
+            ftp = FTP()
+            ftp.connect('127.0.0.1', self.port, timeout=esa.FTP_TIMEOUT)
+            ftp.login('anonymous', self.user_email)
+            self.ftp = ftp
+        return self.ftp
+
+
+def make_files(count, size):
+    data = os.urandom(size)
+    return dict(('SIR_SAR_L2/2020/01/CS_LTA__SIR_SAR_2__202001{0:02d}T000000_'
+                 '202001{0:02d}T001000_E001.nc'.format(index + 1), data)
+                for index in range(count))
+
+
+def legacy_download(filenames, progress_file):
+    """The original transfer loop: 1 KiB callbacks, progress redrawn on every block."""
+    connection = LocalFTPConnection('benchmark@example.com')
+    ftp = connection.get()
+    state = {}
+
+    def file_byte_handler(data):
+        state['file'].write(data)
+        state['read'] += len(data)
+        esa.progress_bar(state['read'], state['total'], file=progress_file)
+
+    for filename in filenames:
+        with open(os.path.basename(filename), 'wb') as download_file:
+            state.update(file=download_file, read=0, total=ftp.size(filename))
+            ftp.retrbinary('RETR ' + filename, file_byte_handler, 1024)
+    connection.close()
+
+
+def single_download(filenames, progress_file):
+    """FTPTransfer over one connection."""
+    connection = LocalFTPConnection('benchmark@example.com')
+    progress = esa.DownloadProgress(len(filenames), file=progress_file)
+    for filename in filenames:
+        esa.download_file(connection, filename, progress)
+        progress.file_done()
+    connection.close()
+
+
+def pooled_download(filenames, connections, progress_file):
+    """download_files over `connections` connections."""
+    stdout = sys.stdout
+    sys.stdout = progress_file
+    try:
+        failed = esa.download_files('benchmark@example.com', filenames, connections=connections)
+    finally:
+        sys.stdout = stdout
+    if failed:
+        raise RuntimeError('failed to download {0}'.format(failed))
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    """Run the body in a new empty directory, removed afterwards."""
+    directory = tempfile.mkdtemp(prefix='esa-benchmark-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def timed(function, *args):
+    with temporary_directory():
+        time_initial = time.time()
+        function(*args)
+        return time.time() - time_initial
+
+
+def check_resume(server, files, progress_file, rest):
+    """Download `files` over half-done .part files, with REST accepted or refused.
+
+    Raises AssertionError unless every file arrives intact, and with only
+    the missing halves sent when REST is accepted.
+    """
+    server.rest = rest
+    server.sent_bytes = 0
+    try:
+        with temporary_directory():
+            for filename, data in files.items():
+                with open(os.path.basename(filename) + '.part', 'wb') as part:
+                    part.write(data[:len(data) // 2])
+            pooled_download(sorted(files), 2, progress_file)
+            for filename, data in files.items():
+                with open(os.path.basename(filename), 'rb') as downloaded:
+                    assert downloaded.read() == data, '{0} differs'.format(filename)
+                assert not os.path.exists(os.path.basename(filename) + '.part'), \
+                    '{0}.part was left behind'.format(filename)
+    finally:
+        server.rest = True
+    expected = sum(len(data) - (len(data) // 2 if rest else 0) for data in files.values())
+    assert server.sent_bytes == expected, 'server sent {0} bytes, expected {1}'.format(
+        server.sent_bytes, expected)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=10, help='number of files')
+    parser.add_argument('--size', type=float, default=20.0, help='size of each file in MB')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds added to every FTP command')
+    parser.add_argument('--connections', default='1,4',
+                        help='comma separated connection counts for the pooled runs')
+    parser.add_argument('--skip-legacy', action='store_true',
+                        help='do not run the slow 1 KiB callback path')
+    args = parser.parse_args(argv)
+
+    files = make_files(args.files, int(args.size * 1024 * 1024))
+    server = FakeFTPServer(files, latency=args.latency / 1000.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    LocalFTPConnection.port = server.server_address[1]
+    esa.FTPConnection = LocalFTPConnection
+
+    filenames = sorted(files)
+    total_mb = sum(len(data) for data in files.values()) / 1e6
+    runs = []
+    if not args.skip_legacy:
+        runs.append(('legacy 1 KiB callbacks', legacy_download, ()))
+    runs.append(('FTPTransfer, 1 connection', single_download, ()))
+    for connections in [int(value) for value in args.connections.split(',')]:
+        runs.append(('pool, {0} connections'.format(connections), pooled_download,
+                     (connections,)))
+
+    print('{0:<28} {1:>10} {2:>10} {3:>10}'.format('path', 'seconds', 'files/s', 'MB/s'))
+    try:
+        with open(os.devnull, 'w') as progress_file:
+            for name, function, extra in runs:
+                seconds = timed(function, filenames, *(extra + (progress_file,)))
+                print('{0:<28} {1:>10.3f} {2:>10.2f} {3:>10.1f}'.format(
+                    name, seconds, len(filenames) / seconds, total_mb / seconds))
+
+            resume_files = dict((filename, files[filename]) for filename in filenames[:4])
+            check_resume(server, resume_files, progress_file, rest=True)
+            print('resumed {0} .part files with REST'.format(len(resume_files)))
+            check_resume(server, resume_files, progress_file, rest=False)
+            print('restarted {0} .part files with REST refused'.format(len(resume_files)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
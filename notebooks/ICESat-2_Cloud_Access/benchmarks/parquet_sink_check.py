@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Checks that a ParquetSink dataset stays readable across an interrupted write.
+
+Reads synthetic ATL10-like granules (see read_atl10_benchmark.py) with
+iter_atl10 and writes them to a ParquetSink, and:
+
+* kills the write of one granule between pq.write_table and os.replace, the
+  crash the sink is meant to survive, and adds a truncated temporary file
+  as a job killed part way through writing would leave;
+* checks that pd.read_parquet and pq.read_table still read the dataset with
+  those files in place, and that it holds only the completed granules;
+* reopens the sink, checks that the temporary files are gone and that the
+  interrupted granule is not marked complete, writes it again and checks the
+  dataset against read_atl10.
+
+For example:
+
+    $ python parquet_sink_check.py --granules=3 --segments=20000
+
+Exits with an error on the first failed check.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import read_atl10_benchmark as benchmark  # noqa: E402
+
+atl10 = benchmark.atl10
+
+
+class Crash(Exception):
+    """Stands in for the job being killed."""
+
+
+def temporary_files(root):
+    return [name for _, _, names in os.walk(root) for name in names if name.endswith('.tmp')]
+
+
+def check_readable(root, rows):
+    """Raises AssertionError unless both readers see exactly `rows` rows."""
+    frame = pd.read_parquet(root)
+    table = pq.read_table(root)
+    assert len(frame) == rows, 'pd.read_parquet read {0} rows, expected {1}'.format(len(frame), rows)
+    assert table.num_rows == rows, 'pq.read_table read {0} rows, expected {1}'.format(table.num_rows, rows)
+    return frame
+
+
+def write_interrupted(sink, file, table):
+    """Writes `file` with os.replace failing, leaving its first temporary file behind."""
+    replace = os.replace
+
+    def crash(src, dst):
+        raise Crash(src)
+
+    os.replace = crash
+    try:
+        sink.write(file, table)
+    except Crash as crash_error:
+        leftover = crash_error.args[0]
+    else:
+        raise AssertionError('the interrupted write completed')
+    finally:
+        os.replace = replace
+    # A second partition file cut off half way through, as if killed during pq.write_table
+    with open(leftover, 'rb') as leftover_file:
+        data = leftover_file.read()
+    truncated = os.path.join(os.path.dirname(leftover), '_truncated.parquet.tmp')
+    with open(truncated, 'wb') as truncated_file:
+        truncated_file.write(data[:len(data) // 2])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--granules', type=int, default=3, help='number of granules, at least 2')
+    parser.add_argument('--segments', type=int, default=20000,
+                        help='freeboard segments per beam in each granule')
+    args = parser.parse_args(argv)
+
+    granules = {}
+    for index in range(max(args.granules, 2)):
+        path = '/ATLAS/ATL10/006/ATL10-02_{0:08d}_006_01.h5'.format(index)
+        granules[path] = benchmark.make_granule(args.segments, orient=index % 2, seed=index)
+    server = benchmark.start_server(granules, 0.0)
+    urls = ['http://127.0.0.1:{0}{1}'.format(server.server_address[1], path) for path in granules]
+    root = os.path.join(tempfile.mkdtemp(prefix='parquet-sink-'), 'atl10.parquet')
+
+    try:
+        tables = dict(atl10.iter_atl10(urls, environment='local'))
+        expected = atl10.read_atl10(urls, environment='local', output='dataframe')
+
+        sink = atl10.ParquetSink(root)
+        for url in urls[:-1]:
+            sink.write(url, tables[url])
+        rows = sum(tables[url].num_rows for url in urls[:-1])
+        write_interrupted(sink, urls[-1], tables[urls[-1]])
+        leftovers = temporary_files(root)
+        assert leftovers, 'the interrupted write left no temporary files'
+        check_readable(root, rows)
+        print('readable with {0} temporary files left behind'.format(len(leftovers)))
+
+        sink = atl10.ParquetSink(root)
+        assert not temporary_files(root), 'temporary files survived reopening the sink'
+        assert not sink.is_complete(urls[-1]), 'the interrupted granule is marked complete'
+        assert all(sink.is_complete(url) for url in urls[:-1]), 'a completed granule was forgotten'
+        sink.write(urls[-1], tables[urls[-1]])
+        frame = check_readable(root, len(expected))
+        assert np.array_equal(np.sort(frame['beam_fb_height'].to_numpy()),
+                              np.sort(expected['beam_fb_height'].to_numpy())), 'dataset differs from read_atl10'
+        print('resumed dataset matches read_atl10: {0} rows'.format(len(frame)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(os.path.dirname(root))
+    print('ParquetSink survives an interrupted write')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Offline benchmark for the h5coro read path of h5cloud/read_atl10.py.
+
+Writes synthetic ATL10-like granules with h5py (same group layout, dtypes,
+chunking and compression as the freeboard datasets read_atl10 uses) and
+serves them from a local HTTP server that answers Range requests and can add
+latency to every response, standing in for the NSIDC HTTPS endpoint that
+webdriver.HTTPDriver talks to.
+
+Each read mode is timed over the same granules and reports seconds per
+granule, the CPU time of this process (worker processes are not counted),
+the number of HTTP requests and of connections they were made over, and the
+bytes transferred. For example:
+
+    $ python read_atl10_benchmark.py --granules=8 --latency=100
+    $ python read_atl10_benchmark.py --segments=200000 --executors=1 --repeat=3
+    $ python read_atl10_benchmark.py --bbox=-180,-78,-160,-74 --modes=single-pass,pushdown
+    $ python read_atl10_benchmark.py --segments=300000 --bbox=-180,-78,180,-77.5 \
+          --modes=pushdown,metadata-cache --repeat=2
+
+The modes must agree on the rows they return; a mismatch is reported as an
+error rather than a timing.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import h5py
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'h5cloud'))
+import read_atl10 as atl10  # noqa: E402
+
+ATLAS_SDP_GPS_EPOCH = 1198800018.0
+FILL_VALUE = np.float32(3.4028235e38)
+CHUNK_SIZE = 10000
+
+
+def make_granule(segments, orient, seed=0):
+    """Returns the bytes of an ATL10-like granule with `segments` rows per beam."""
+    rng = np.random.default_rng(seed)
+    path = tempfile.mktemp(prefix='atl10-benchmark-', suffix='.h5')
+    try:
+        with h5py.File(path, 'w') as h5:
+            h5['orbit_info/sc_orient'] = np.array([orient], dtype=np.int8)
+            h5['ancillary_data/atlas_sdp_gps_epoch'] = np.array([ATLAS_SDP_GPS_EPOCH])
+            # One pass over the Southern Ocean: out to -78 and back to -60.
+            along = np.linspace(0.0, 1.0, segments)
+            start_lon = rng.uniform(-180.0, 180.0)
+            for index, beam in enumerate(atl10.BEAMS):
+                group = h5.create_group(beam + '/freeboard_segment')
+                offset = index * 0.01
+                columns = {
+                    'latitude': -60.0 - 18.0 * np.sin(np.pi * along) - offset,
+                    'longitude': (start_lon + 120.0 * along + offset + 180.0) % 360.0 - 180.0,
+                    'delta_time': 1.6e8 + 600.0 * along,
+                    'seg_dist_x': 1e7 + 3e6 * along,
+                    'heights/height_segment_length_seg': rng.uniform(10, 200, segments).astype(np.float32),
+                    'beam_fb_height': rng.gamma(2.0, 0.15, segments).astype(np.float32),
+                    'heights/height_segment_type': rng.integers(0, 10, segments).astype(np.int8),
+                }
+                columns['beam_fb_height'][rng.random(segments) < 0.05] = FILL_VALUE
+                for name, values in columns.items():
+                    group.create_dataset(name, data=values, chunks=(min(CHUNK_SIZE, segments),),
+                                         compression='gzip', compression_opts=6)
+        with open(path, 'rb') as granule_file:
+            return granule_file.read()
+    finally:
+        os.remove(path)
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionError, OSError)):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class GranuleHandler(BaseHTTPRequestHandler):
+    """Serves server.granules by path, honouring single byte ranges."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        data = server.granules.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, len(data)
+        value = self.headers.get('Range')
+        if value:
+            first, _, last = value.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = min(int(last) + 1, len(data)) if last else len(data)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', '"{0:x}-{1:x}"'.format(len(data), hash(data[:4096]) & 0xffffffff))
+        self.end_headers()
+        self.wfile.write(data[start:end])
+        with server.lock:
+            server.requests += 1
+            server.bytes += end - start
+
+
+def start_server(granules, latency):
+    server = QuietHTTPServer(('127.0.0.1', 0), GranuleHandler)
+    server.granules = granules
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.bytes = 0
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# name -> keyword arguments for read_atl10
+MODES = {
+    'two-phase': {},
+    'single-pass': {'single_pass': True},
+    'processes': {'single_pass': True, 'backend': 'processes'},
+    'pushdown': {'single_pass': True, 'pushdown': True},
+    'dataframe': {'single_pass': True, 'output': 'dataframe'},
+    'arrow': {'single_pass': True, 'output': 'arrow'},
+    # The first run fills the cache, use --repeat to see the warm runs. These skip the
+    # cache lines that only held object headers and chunk B-tree nodes, which a full
+    # read of these granules rarely has but a --bbox read does.
+    'metadata-cache': {'single_pass': True, 'pushdown': True, 'metadata_cache': None},
+    'pooled': {'single_pass': True, 'pooled': True},
+}
+
+
+def run_once(server, urls, executors, options, bounding_box=None):
+    with server.lock:
+        server.requests = server.bytes = server.connections = 0
+    time_initial = time.time()
+    cpu_initial = time.process_time()
+    df = atl10.read_atl10(urls, bounding_box=bounding_box, executors=executors, environment='local',
+                          **options)
+    seconds = time.time() - time_initial
+    cpu_seconds = time.process_time() - cpu_initial
+    with server.lock:
+        return df, seconds, cpu_seconds, server.requests, server.connections, server.bytes
+
+
+def summary(df):
+    """Row count and a checksum of the freeboard column, order independent."""
+    return len(df), round(float(np.nansum(np.asarray(df['beam_fb_height'], dtype=float))), 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--granules', type=int, default=4, help='number of granules')
+    parser.add_argument('--segments', type=int, default=100000,
+                        help='freeboard segments per beam in each granule')
+    parser.add_argument('--latency', type=float, default=50.0,
+                        help='milliseconds added to every HTTP response')
+    parser.add_argument('--executors', type=int, default=4, help='read_atl10 executors')
+    parser.add_argument('--bbox', help='bounding box passed to read_atl10, "min_lon,min_lat,max_lon,max_lat"')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated modes to compare: ' + ', '.join(MODES))
+    parser.add_argument('--repeat', type=int, default=1, help='runs per mode')
+    args = parser.parse_args(argv)
+
+    cache_directory = tempfile.mkdtemp(prefix='atl10-benchmark-')
+    MODES['metadata-cache']['metadata_cache'] = os.path.join(cache_directory, 'metadata.sqlite')
+
+    print('Writing {0} synthetic granules ...'.format(args.granules))
+    granules = {}
+    for index in range(args.granules):
+        path = '/ATLAS/ATL10/006/ATL10-02_{0:08d}_006_01.h5'.format(index)
+        granules[path] = make_granule(args.segments, orient=index % 2, seed=index)
+    server = start_server(granules, args.latency / 1000.0)
+    urls = ['http://127.0.0.1:{0}{1}'.format(server.server_address[1], path) for path in granules]
+
+    print('{0:<14} {1:>10} {2:>12} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10}'.format(
+        'mode', 'seconds', 's/granule', 'cpu s', 'requests', 'conns', 'MB', 'rows'))
+    expected = None
+    try:
+        for mode in args.modes.split(','):
+            for _ in range(args.repeat):
+                df, seconds, cpu_seconds, requests, connections, byte_count = run_once(
+                    server, urls, args.executors, MODES[mode], args.bbox)
+                result = summary(df)
+                if expected is None:
+                    expected = result
+                elif result != expected:
+                    raise RuntimeError('{0} returned {1}, expected {2}'.format(mode, result, expected))
+                print('{0:<14} {1:>10.3f} {2:>12.3f} {3:>10.3f} {4:>10} {5:>10} {6:>10.1f} {7:>10}'.format(
+                    mode, seconds, seconds / len(urls), cpu_seconds, requests, connections,
+                    byte_count / 1e6, len(df)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Checks the S3 transport of ATL10_V6_download_script.py against local stand-ins.
+
+Uses the Earthdata and S3 stand-ins of download_benchmark.py, whose S3
+endpoint checks every request's SigV4 signature, and:
+
+* downloads every granule over S3 as signed range segments and checks that
+  no byte came from the HTTPS data host;
+* expires the S3 credentials between two batches and checks that the 403
+  makes the client fetch new ones and carry on over S3;
+* resumes a `.part` file of an older version of a granule, recorded once by
+  ETag (sent to S3 as If-Match) and once by Last-Modified date (sent as
+  If-Unmodified-Since), and checks that the 412 restarts the download;
+* makes the S3 endpoint stop answering part way through a segmented
+  download and checks that the rest of it comes over HTTPS.
+
+For example:
+
+    $ python s3_transport_check.py --files=4 --size=2
+
+Exits with an error on the first failed check.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import download_benchmark as benchmark  # noqa: E402
+
+nsidc = benchmark.nsidc
+
+
+def make_client(earthdata, directory, segment_threshold=0):
+    return nsidc.NSIDCDownloadClient(benchmark.USERNAME, benchmark.PASSWORD, quiet=True,
+                                     workers=2, segment_threshold=segment_threshold,
+                                     directory=directory, s3=True,
+                                     s3_endpoint_url=earthdata.url('s3'))
+
+
+def check_results(earthdata, results, transport='s3'):
+    """Raises AssertionError unless every file arrived intact over `transport`."""
+    for result in results:
+        assert result.ok, '{0} failed: {1}'.format(result.url, result.error)
+        assert result.transport == transport, '{0} came over {1}, expected {2}'.format(
+            result.url, result.transport, transport)
+        with open(result.filename, 'rb') as downloaded:
+            assert downloaded.read() == earthdata.data, '{0} differs'.format(result.filename)
+
+
+def https_object_responses(earthdata):
+    return earthdata.responses['data', 206] + earthdata.responses['data', 200] \
+        - earthdata.requests['credentials']
+
+
+def check_segments(earthdata, directory):
+    with make_client(earthdata, directory) as client:
+        results = client.download(list(client.search('ATL10', '006')))
+    check_results(earthdata, results)
+    segments = nsidc.S3_SEGMENTS
+    assert earthdata.responses['s3', 206] == len(results) * (segments - 1), \
+        '{0} range responses from S3, expected {1}'.format(earthdata.responses['s3', 206],
+                                                           len(results) * (segments - 1))
+    assert not https_object_responses(earthdata), 'data was read over HTTPS'
+    print('{0} files read from S3 as {1} signed segments each'.format(len(results), segments))
+
+
+def check_refresh(earthdata, directory):
+    credentials = earthdata.requests['credentials']
+    refused = earthdata.responses['s3', 403]
+    with make_client(earthdata, directory, segment_threshold=nsidc.S3_SEGMENT_THRESHOLD) as client:
+        granules = list(client.search('ATL10', '006'))
+        half = len(granules) // 2
+        results = client.download(granules[:half])
+        assert earthdata.requests['credentials'] == credentials + 1, \
+            'credentials fetched more than once'
+        earthdata.expire_s3_credentials()
+        results += client.download(granules[half:])
+        assert client.s3_transport.enabled, client.s3_transport.disabled_reason
+    check_results(earthdata, results)
+    assert earthdata.responses['s3', 403] > refused, 'S3 never refused the expired credentials'
+    assert earthdata.requests['credentials'] > credentials + 1, 'credentials were not refreshed'
+    print('expired credentials refreshed after {0} refusals'.format(
+        earthdata.responses['s3', 403] - refused))
+
+
+def check_restart(earthdata, directory):
+    with make_client(earthdata, directory) as client:
+        granules = list(client.search('ATL10', '006'))[:2]
+        for granule, validator in zip(granules, ('etag', 'last_modified')):
+            filename = os.path.join(directory, granule['url'].split('/')[-1])
+            with open(filename + '.part', 'wb') as part:
+                part.write(earthdata.data[:len(earthdata.data) // 2])
+            nsidc.save_part_validator(filename + '.part', getattr(earthdata, validator))
+        # The granules are reprocessed while the .part files wait.
+        earthdata.data = os.urandom(len(earthdata.data))
+        failed = earthdata.responses['s3', 412]
+        results = client.download(granules)
+    check_results(earthdata, results)
+    assert earthdata.responses['s3', 412] == failed + 2, \
+        '{0} precondition failures, expected 2'.format(earthdata.responses['s3', 412] - failed)
+    assert not https_object_responses(earthdata), 'data was read over HTTPS'
+    print('stale .part files restarted after If-Match and If-Unmodified-Since failed')
+
+
+def check_fallback(earthdata, directory):
+    with make_client(earthdata, directory) as client:
+        granules = list(client.search('ATL10', '006'))[:1]
+        # Let the first response and a few segments through, then go dark.
+        earthdata.s3_outage_after = earthdata.requests['s3'] + nsidc.S3_SEGMENTS // 2
+        try:
+            results = client.download(granules)
+        finally:
+            earthdata.s3_outage_after = None
+        reason = client.s3_transport.disabled_reason
+    check_results(earthdata, results)
+    assert reason and reason.startswith('could not reach S3'), 'S3 was not disabled: {0}'.format(
+        reason)
+    assert earthdata.responses['data', 206], 'no segment was read over HTTPS'
+    print('switched to HTTPS after {0} segments: {1}'.format(
+        earthdata.responses['data', 206], reason))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=4, help='number of granules, at least 2')
+    parser.add_argument('--size', type=float, default=2.0, help='size of each granule in MB')
+    args = parser.parse_args(argv)
+
+    earthdata = benchmark.FakeEarthdata(files=max(args.files, 2),
+                                        size=int(args.size * 1024 * 1024)).start()
+    benchmark.point_script_at(earthdata)
+    try:
+        for check in (check_segments, check_refresh, check_restart, check_fallback):
+            directory = tempfile.mkdtemp(prefix='nsidc-s3-check-')
+            try:
+                check(earthdata, directory)
+            finally:
+                shutil.rmtree(directory)
+    finally:
+        earthdata.stop()
+    print('S3 transport checks passed')
+
+
+if __name__ == '__main__':
+    main()
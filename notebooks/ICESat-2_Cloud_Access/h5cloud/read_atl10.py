@@ -2,19 +2,66 @@
 
 #import coiled
 
+import os
+import pickle
+from bisect import bisect_right
+import sqlite3
+import threading
+import time
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from rich import print as rprint
-from itertools import product
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice, product
+from pqdm.processes import pqdm as process_pqdm
 from pqdm.threads import pqdm
 
 
+import boto3
 import earthaccess
+import requests
 from h5coro import s3driver, webdriver
 import h5coro
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
+BEAMS = [f"gt{i}{side}" for i in [1, 2, 3] for side in ["l", "r"]]
+
+ANCILLARY_DATASETS = ["orbit_info/sc_orient", "ancillary_data/atlas_sdp_gps_epoch"]
+
+BEAM_DATASETS = ["freeboard_segment/latitude",
+                 "freeboard_segment/longitude",
+                 "freeboard_segment/delta_time",
+                 "freeboard_segment/seg_dist_x",
+                 "freeboard_segment/heights/height_segment_length_seg",
+                 "freeboard_segment/beam_fb_height",
+                 "freeboard_segment/heights/height_segment_type"]
+
+COORDINATE_DATASETS = ["freeboard_segment/latitude", "freeboard_segment/longitude"]
+
+GPS_EPOCH = pd.to_datetime('1980-01-06 00:00:00')
+
+# Inside-box stretches of a track closer than this many rows (the ATL10 chunk size) are read as one
+PUSHDOWN_MERGE_GAP = 10000
+
+# Compact schema (compact=True): measurements that fit float32 and flags that fit int8.
+# latitude, longitude and seg_dist_x stay float64, float32 would round them to metres.
+COMPACT_FLOAT32 = ["height_segment_length_seg", "beam_fb_height"]
+COMPACT_INT8 = ["height_segment_type"]
+
+# Default location of the h5coro metadata cache (metadata_cache=True)
+METADATA_CACHE_FILE = os.path.expanduser("~/.atl10_h5coro_metadata.sqlite")
+
+# Connections each worker process keeps open per host (HTTP) or per S3 client (pooled=True)
+POOL_MAX_CONNECTIONS = 16
+
+# Rows per Parquet row group written by ParquetSink
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
 
 
 def get_strong_beams(f):
@@ -29,87 +76,752 @@ def get_strong_beams(f):
         raise KeyError("Spacecraft orientation neither forward nor backward")
 
 
+def get_driver(environment, pooled=False, max_connections=POOL_MAX_CONNECTIONS):
+    """Returns the h5coro driver class for reading from `environment`
 
+    pooled: use drivers that share the sessions of SESSION_POOL, capped at
+        max_connections, instead of opening new ones for every file
+    """
+    if pooled:
+        driver = PooledHTTPDriver if environment == "local" else PooledS3Driver
+        return partial(driver, max_connections=max_connections)
+    if environment == "local":
+        return webdriver.HTTPDriver
+    else:
+        return s3driver.S3Driver
 
 
+class SessionPool:
+    """HTTP sessions and S3 clients shared by every file a worker process reads.
 
-def read_atl10(files, bounding_box=None, executors=4, environment="local", credentials=None):
-    """Returns a consolidated GeoPandas dataframe for a set of ATL10 file pointers.
+    h5coro's drivers open a requests.Session, or a boto3 session and client, per file,
+    so every granule pays for new TLS connections and credential setup. The pooled
+    drivers below take theirs from here instead: one per set of credentials and
+    connection cap, created on first use and kept alive for the life of the process.
+    Connections are capped per host (per client for S3) and further reads wait for a
+    free one. A pool inherited across fork() starts afresh in the child.
+    """
 
-    Parameters:
-        files (list[S3FSFile]): list of authenticated fsspec file references to ATL10 on S3 (via earthaccess)
-        executors (int): number of threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.http_sessions = {}
+        self.s3_clients = {}
+
+    @staticmethod
+    def _key(credentials, max_connections):
+        if isinstance(credentials, dict):
+            credentials = tuple(sorted(credentials.items()))
+        return credentials, max_connections
+
+    def http_session(self, credentials, max_connections=POOL_MAX_CONNECTIONS):
+        """Returns the shared requests.Session for an EDL token (or no credentials)"""
+        key = self._key(credentials, max_connections)
+        with self._lock:
+            if self.pid != os.getpid():
+                self._reset()
+            if key not in self.http_sessions:
+                session = requests.Session()
+                # Same retry policy as webdriver.HTTPDriver
+                retry_strategy = Retry(total=3, status_forcelist=[500, 502, 503, 504],
+                                       allowed_methods=["HEAD", "GET", "OPTIONS"], backoff_factor=1)
+                adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True, max_retries=retry_strategy)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if type(credentials) == str:
+                    session.headers.update({"Authorization": f"Bearer {credentials}"})
+                self.http_sessions[key] = session
+            return self.http_sessions[key]
+
+    def s3_client(self, credentials, create_client, max_connections=POOL_MAX_CONNECTIONS):
+        """Returns the shared S3 client for a set of credentials, made by create_client() on first use"""
+        key = self._key(credentials, max_connections)
+        with self._lock:
+            if self.pid != os.getpid():
+                self._reset()
+            if key not in self.s3_clients:
+                self.s3_clients[key] = create_client()
+            return self.s3_clients[key]
+
+
+SESSION_POOL = SessionPool()
+
+
+class PooledHTTPDriver(webdriver.HTTPDriver):
+    """HTTPDriver reading over the shared session of SESSION_POOL
+
+    Also records the ETag of the file, like ETagHTTPDriver, without a hook on the shared session.
+    """
 
+    def __init__(self, resource, credentials, max_connections=POOL_MAX_CONNECTIONS):
+        # HTTPDriver.__init__ would build a session and connection pool for this file alone
+        self.resource = resource
+        self.cached_credentials = credentials
+        self.max_connections = max_connections
+        self.session = SESSION_POOL.http_session(credentials, max_connections)
+        self.adapter = None
+        self.etag = None
+
+    def copy(self, max_connections=None):
+        return PooledHTTPDriver(self.resource, self.cached_credentials, self.max_connections)
+
+    def read(self, pos, size):
+        headers = {"Range": f"bytes={pos}-{pos+size-1}"}
+        try:
+            response = self.session.get(self.resource, headers=headers, allow_redirects=True, timeout=30)
+            if response.status_code in [200, 206]:
+                if self.etag is None:
+                    self.etag = response.headers.get("ETag")
+                return response.content
+            webdriver.logger.warning(f"HTTP error {response.status_code} - Failed to read")
+        except requests.RequestException as e:
+            webdriver.logger.error(f"Request failed with error: {e}")
+        raise webdriver.FatalError(f"Failed to read range {pos}-{pos+size-1} after retries")
+
+    def close(self):
+        # The session belongs to the pool and stays open for the next file
+        self.session = None
+
+
+class PooledS3Driver(s3driver.S3Driver):
+    """S3Driver reading through the shared client of SESSION_POOL
+
+    Also records the ETag of the object, like ETagS3Driver.
     """
-    if environment == "local":
-        driver = webdriver.HTTPDriver
-    else:
-        driver = s3driver.S3Driver
 
-    GPS_EPOCH = pd.to_datetime('1980-01-06 00:00:00')
+    def __init__(self, resource, credentials, session=None, max_connections=POOL_MAX_CONNECTIONS):
+        # S3Driver.__init__ would build a boto3 session and client for this object alone
+        self.cached_credentials = credentials
+        self.resourcePath = list(filter(("").__ne__, resource.split("/")))
+        self.max_connections = max_connections
+        self.client = SESSION_POOL.s3_client(credentials, self._create_client, max_connections)
+        self.bucket_name = self.resourcePath[0]
+        self.key = "/".join(self.resourcePath[1:])
+        self._closed = False
+        self.etag = None
+
+    def _create_client(self):
+        return self.create_session(self.cached_credentials).client(
+            "s3",
+            use_ssl=False,  # as S3Driver
+            config=boto3.session.Config(
+                max_pool_connections=self.max_connections,
+                retries={"max_attempts": 2, "mode": "adaptive"},
+                read_timeout=5,
+                connect_timeout=2,
+                tcp_keepalive=True
+            ),
+        )
+
+    def copy(self, max_connections=None):
+        return PooledS3Driver("/".join(self.resourcePath), self.cached_credentials, None, self.max_connections)
+
+    def read(self, offset, size):
+        if self._closed:
+            raise RuntimeError("S3Driver has been closed and cannot be used.")
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                              Range=f"bytes={offset}-{offset + size - 1}")
+            if self.etag is None:
+                self.etag = response.get("ETag")
+            return response["Body"].read()
+        except Exception as e:
+            s3driver.logger.error(f"Error reading {self.key} from {self.bucket_name}: {e}")
+            return None
+
+    def close(self):
+        # The client belongs to the pool and stays open for the next object
+        self._closed = True
+
+
+class ETagHTTPDriver(webdriver.HTTPDriver):
+    """HTTPDriver that remembers the ETag of the object it reads, for MetadataCache"""
+
+    def __init__(self, resource, credentials, *args, **kwargs):
+        super().__init__(resource, credentials, *args, **kwargs)
+        self.etag = None
+        self.session.hooks["response"].append(self._record_etag)
+
+    def _record_etag(self, response, *args, **kwargs):
+        if self.etag is None and response.status_code in (200, 206):
+            self.etag = response.headers.get("ETag")
+
+    def copy(self, max_connections=None):
+        return ETagHTTPDriver(self.resource, self.cached_credentials, max_connections)
+
+
+class ETagS3Driver(s3driver.S3Driver):
+    """S3Driver that remembers the ETag of the object it reads, for MetadataCache"""
+
+    def __init__(self, resource, credentials, *args, **kwargs):
+        super().__init__(resource, credentials, *args, **kwargs)
+        self.etag = None
+        self.client.meta.events.register("after-call.s3.GetObject", self._record_etag)
+
+    def _record_etag(self, parsed=None, **kwargs):
+        if self.etag is None and parsed:
+            self.etag = parsed.get("ETag")
+
+    def copy(self, max_connections=None):
+        return ETagS3Driver("/".join(self.resourcePath), self.cached_credentials, self.session, max_connections)
+
+
+# Driver to use in place of each h5coro driver when reads go through a MetadataCache
+ETAG_DRIVERS = {webdriver.HTTPDriver: ETagHTTPDriver, s3driver.S3Driver: ETagS3Driver}
+
+
+class IndexedH5Coro(h5coro.H5Coro):
+    """H5Coro that can answer the small reads of HDF5 structures from saved bytes.
+
+    h5coro decodes object headers and chunk B-tree nodes field by field, with reads of at
+    most FIELD_SIZE bytes; each one costs a cache line fetch unless that line is already
+    held for data. This records the position and size of every such read, and returns
+    them from `blocks` (start address -> bytes, filled by MetadataCache.load) when they
+    are covered there, so a granule whose chunk index is cached goes straight to the byte
+    ranges of its chunks.
+    """
 
-    def read_h5coro(file):
-        """Reads datasets required for creating gridded freeboard from a single ATL10 file
+    FIELD_SIZE = 8
+    # Reads closer together than this are saved as one block, bytes in between included
+    BLOCK_GAP = 64
+
+    def __init__(self, *args, **kwargs):
+        self.blocks = {}
+        self._block_starts = []
+        self._block_views = {}
+        self.field_reads = set()
+        super().__init__(*args, **kwargs)
+
+    def set_blocks(self, blocks):
+        self.blocks = dict(blocks)
+        self._block_starts = sorted(self.blocks)
+        # h5coro expects the memoryviews its cache lines hand out
+        self._block_views = {start: memoryview(block) for start, block in self.blocks.items()}
+
+    def ioRequest(self, pos, size, caching=True, prefetch=False):
+        if caching and size <= self.FIELD_SIZE:
+            index = bisect_right(self._block_starts, pos) - 1
+            if index >= 0:
+                start = self._block_starts[index]
+                block = self._block_views[start]
+                if pos + size <= start + len(block):
+                    return block[pos - start:pos - start + size]
+            self.field_reads.add((pos, size))
+        return super().ioRequest(pos, size, caching, prefetch)
+
+    def new_blocks(self):
+        """Returns the blocks covering the field reads made since the last set_blocks"""
+        blocks = {}
+        start = end = None
+        for pos, size in sorted(self.field_reads):
+            if start is not None and pos <= end + self.BLOCK_GAP:
+                end = max(end, pos + size)
+                continue
+            if start is not None:
+                blocks[start] = bytes(super().ioRequest(start, end - start))
+            start, end = pos, pos + size
+        if start is not None:
+            blocks[start] = bytes(super().ioRequest(start, end - start))
+        return blocks
+
+
+def merge_blocks(*sources):
+    """Merges {start: bytes} dicts, joining blocks that overlap or touch"""
+    merged = {}
+    start = block = None
+    for pos, data in sorted(item for source in sources for item in source.items()):
+        if block is not None and pos <= start + len(block):
+            block = block + data[start + len(block) - pos:]
+            continue
+        if block is not None:
+            merged[start] = block
+        start, block = pos, data
+    if block is not None:
+        merged[start] = block
+    return merged
+
+
+class MetadataCache:
+    """Local SQLite cache of the HDF5 metadata h5coro resolves for each granule.
+
+    h5coro walks the object headers of every dataset it reads (data address, dimensions,
+    type, chunk layout and filters) and keeps the result in H5Coro.metadataTable, then
+    walks the chunk B-tree of the dataset to find its chunks. This stores that table and
+    the bytes of the structures read along the way (see IndexedH5Coro), keyed by the
+    granule URL and the ETag returned with its first byte range, and loads them into the
+    next IndexedH5Coro opened on the same object, so neither object headers nor B-tree
+    nodes are fetched again and only the cache lines holding chunk data are read. The
+    ETag arrives with the superblock read h5coro makes anyway, so a lookup costs no extra
+    request; a changed object gets a new ETag and is walked afresh.
 
-        file: an authenticated fsspec file reference on S3 (returned by earthaccess)
+    Parameters:
+        path (str): SQLite file, shared safely between threads and processes
+    """
 
-        returns: a list of geopandas dataframes
+    def __init__(self, path=METADATA_CACHE_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                " url TEXT, etag TEXT, datasets BLOB, updated REAL, PRIMARY KEY (url, etag))")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                " url TEXT, etag TEXT, blocks BLOB, PRIMARY KEY (url, etag))")
+
+    @staticmethod
+    def key(h5):
+        """Returns the (url, etag) of an open H5Coro, or None if its driver saw no ETag"""
+        etag = getattr(h5.driver, "etag", None)
+        return (str(h5.resource), etag) if etag else None
+
+    def load(self, h5):
+        """Fills h5.metadataTable, and h5.blocks of an IndexedH5Coro, from the cache
+
+        Returns the number of datasets loaded.
         """
-        # Open file object
+        if isinstance(h5, IndexedH5Coro):
+            # Only reads from here on can be saved by cached blocks, not the superblock's
+            h5.field_reads.clear()
+        key = self.key(h5)
+        if key is None:
+            return 0
+        with self._lock:
+            row = self.db.execute("SELECT datasets FROM metadata WHERE url = ? AND etag = ?", key).fetchone()
+            blocks = self.db.execute("SELECT blocks FROM blocks WHERE url = ? AND etag = ?", key).fetchone()
+        if isinstance(h5, IndexedH5Coro) and blocks is not None:
+            h5.set_blocks(pickle.loads(blocks[0]))
+        if row is None:
+            return 0
+        datasets = pickle.loads(row[0])
+        for dataset, meta in datasets.items():
+            h5.metadataTable.setdefault(dataset, meta)
+        return len(datasets)
+
+    def save(self, h5):
+        """Stores h5.metadataTable and any new blocks, replacing what was cached for older
+        versions of the granule"""
+        key = self.key(h5)
+        if key is None:
+            return
+        datasets = pickle.dumps(dict(h5.metadataTable), protocol=pickle.HIGHEST_PROTOCOL)
+        blocks = None
+        if isinstance(h5, IndexedH5Coro):
+            blocks = pickle.dumps(merge_blocks(h5.blocks, h5.new_blocks()), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM metadata WHERE url = ? AND etag != ?", key)
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", key + (datasets, time.time()))
+            if blocks is not None:
+                self.db.execute("DELETE FROM blocks WHERE url = ? AND etag != ?", key)
+                self.db.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)", key + (blocks,))
+
+    def close(self):
+        self.db.close()
+
+
+def parse_bounding_box(bounding_box):
+    """Returns a "min_lon,min_lat,max_lon,max_lat" string as a list of floats, or None"""
+    if bounding_box is None:
+        return None
+    return [float(coord) for coord in bounding_box.split(",")]
+
+
+def in_bounding_box(longitude, latitude, bbox):
+    """Returns a boolean mask of the points inside bbox, edges included like GeoDataFrame.cx"""
+    return (longitude >= bbox[0]) & (longitude <= bbox[2]) & (latitude >= bbox[1]) & (latitude <= bbox[3])
+
+
+def inside_ranges(longitude, latitude, bbox, merge_gap=PUSHDOWN_MERGE_GAP):
+    """Returns the [start, end) row ranges of a track that fall inside bbox
+
+    Ranges closer than merge_gap rows are merged, reading a few points outside the
+    box rather than making another request for what is likely the same chunk.
+    """
+    inside = in_bounding_box(longitude, latitude, bbox)
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], inside, [False]]).astype(np.int8)))
+    ranges = []
+    for start, end in zip(edges[0::2], edges[1::2]):
+        if ranges and start - ranges[-1][1] < merge_gap:
+            ranges[-1][1] = int(end)
+        else:
+            ranges.append([int(start), int(end)])
+    return ranges
+
+
+def read_granule(file, driver, credentials=None, single_pass=False, bbox=None, metadata_cache=None):
+    """Reads the strong beams of a single ATL10 file
+
+    file: an authenticated fsspec file reference on S3 (returned by earthaccess)
+    bbox: when given, latitude and longitude are read first and the other datasets
+        only for the rows inside the box (a spatial pushdown)
+    metadata_cache: path of a MetadataCache file to read dataset metadata from and add to
+
+    returns: a list of (beam, dict of numpy arrays, row numbers) tuples, with delta_time
+        converted to datetimes and beam_fb_height fill values set to NaN. With a bbox a
+        beam can appear once per stretch of track inside the box; rows outside the box
+        are not guaranteed to be dropped.
+    """
+    # Open file object
+    if metadata_cache:
+        cache = MetadataCache(metadata_cache)
+        h5 = IndexedH5Coro(file, ETAG_DRIVERS.get(driver, driver), credentials=credentials)
+        cached = cache.load(h5)
+    else:
         h5 = h5coro.H5Coro(file, driver, credentials=credentials)
 
+    # With a pushdown the first round only needs the coordinates
+    first_datasets = COORDINATE_DATASETS if bbox is not None else BEAM_DATASETS
+
+    if single_pass:
+        # Ask for every beam up front; indexing the promise waits on just that dataset
+        ds_list = ["/".join(p) for p in list(product(BEAMS, first_datasets))]
+        f = h5.readDatasets(datasets=ANCILLARY_DATASETS + ds_list, block=False)
+        strong_beams = get_strong_beams(f)
+        atlas_sdp_gps_epoch = f["ancillary_data/atlas_sdp_gps_epoch"][:]
+    else:
         # Get strong beams based on orientation
-        ancillary_datasets = ["orbit_info/sc_orient", "ancillary_data/atlas_sdp_gps_epoch"]
-        f = h5.readDatasets(datasets=ancillary_datasets, block=True)
+        f = h5.readDatasets(datasets=ANCILLARY_DATASETS, block=True)
         strong_beams = get_strong_beams(f)
         atlas_sdp_gps_epoch = f["ancillary_data/atlas_sdp_gps_epoch"][:]
 
-        # Create list of datasets to load
-        datasets = ["freeboard_segment/latitude",
-                    "freeboard_segment/longitude",
-                    "freeboard_segment/delta_time",
-                    "freeboard_segment/seg_dist_x",
-                    "freeboard_segment/heights/height_segment_length_seg",
-                    "freeboard_segment/beam_fb_height",
-                    "freeboard_segment/heights/height_segment_type"]
-        ds_list = ["/".join(p) for p in list(product(strong_beams, datasets))]
-        # Load datasets
+        # Load datasets for the strong beams only
+        ds_list = ["/".join(p) for p in list(product(strong_beams, first_datasets))]
         f = h5.readDatasets(datasets=ds_list, block=True)
-        # rprint(f["gt2l/freeboard_segment/latitude"], type(f["gt2l/freeboard_segment/latitude"]))
 
-        # Create a list of geopandas.DataFrames containing beams
-        tracks = []
+    tracks = []
+    if bbox is None:
+        for beam in strong_beams:
+            ds = {dataset.split("/")[-1]: f[f"{beam}/{dataset}"][:] for dataset in BEAM_DATASETS}
+            tracks.append((beam, ds, np.arange(len(ds["latitude"]))))
+    else:
+        # Request the hyperslabs inside the box for every beam before waiting on any of them
+        slabs = []
         for beam in strong_beams:
-            ds = {dataset.split("/")[-1]: f[dataset][:] for dataset in ds_list if dataset.startswith(beam)}
+            latitude = f[f"{beam}/freeboard_segment/latitude"][:]
+            longitude = f[f"{beam}/freeboard_segment/longitude"][:]
+            ranges = inside_ranges(longitude, latitude, bbox)
+            if not ranges:
+                # Nothing inside the box: read one row anyway so the empty columns keep their dtypes
+                ranges = [[0, 0]]
+            for start, end in ranges:
+                datasets = [{"dataset": f"{beam}/{dataset}", "hyperslice": [(start, max(end, start + 1))]}
+                            for dataset in BEAM_DATASETS if dataset not in COORDINATE_DATASETS]
+                slabs.append((beam, start, end, latitude, longitude,
+                              h5.readDatasets(datasets=datasets, block=False)))
+        for beam, start, end, latitude, longitude, slab in slabs:
+            ds = {}
+            for dataset in BEAM_DATASETS:
+                name = dataset.split("/")[-1]
+                if name == "latitude":
+                    ds[name] = latitude[start:end]
+                elif name == "longitude":
+                    ds[name] = longitude[start:end]
+                else:
+                    ds[name] = slab[f"{beam}/{dataset}"][:end - start]
+            tracks.append((beam, ds, np.arange(start, end)))
+
+    for beam, ds, rows in tracks:
+        # Convert delta_time to datetime
+        ds["delta_time"] = GPS_EPOCH + pd.to_timedelta(ds["delta_time"]+atlas_sdp_gps_epoch, unit='s')
+        # we don't need nanoseconds to grid daily let alone weekly
+        ds["delta_time"] = ds["delta_time"].astype('datetime64[s]')
+
+        # Set fill values to NaN - assume 100 m as threshold
+        ds["beam_fb_height"] = np.where(ds["beam_fb_height"] > 100, np.nan, ds["beam_fb_height"])
+
+    if metadata_cache:
+        if len(h5.metadataTable) > cached or h5.field_reads:
+            cache.save(h5)
+        cache.close()
+    return tracks
+
+
+def to_compact(columns):
+    """Casts the columns of read_atl10 output to the compact schema, in place
+
+    columns: a dict of numpy arrays or a DataFrame. delta_time becomes int32 seconds
+        since 1970-01-01 (lossless for datetime64[s], good until 2038), measurements
+        float32 and flags int8. Convert times back with pd.to_datetime(..., unit="s").
+    """
+    columns["delta_time"] = np.asarray(columns["delta_time"], dtype="datetime64[s]").astype(np.int64).astype(np.int32)
+    for name in COMPACT_FLOAT32:
+        columns[name] = np.asarray(columns[name], dtype=np.float32)
+    for name in COMPACT_INT8:
+        columns[name] = np.asarray(columns[name]).astype(np.int8)
+    return columns
 
-            # Convert delta_time to datetime
-            ds["delta_time"] = GPS_EPOCH + pd.to_timedelta(ds["delta_time"]+atlas_sdp_gps_epoch, unit='s')
-            # we don't need nanoseconds to grid daily let alone weekly
-            ds["delta_time"] = ds["delta_time"].astype('datetime64[s]')
 
+def read_granule_arrays(file, environment="local", credentials=None, bbox=None, single_pass=False,
+                        pushdown=False, compact=False, metadata_cache=None, pooled=False,
+                        max_connections=POOL_MAX_CONNECTIONS):
+    """Reads a single ATL10 file into flat numpy arrays
+
+    Does the row filtering of the GeoDataFrame path (dropna and the bounding box)
+    with numpy masks, so only the surviving rows are kept (or pickled back to the
+    parent by the process backend) and no per-point geometry is ever built.
+
+    returns: a dict of numpy arrays, with beam stored as int8 indexes into BEAMS,
+        in the compact schema when compact is True
+    """
+    columns = {}
+    driver = get_driver(environment, pooled, max_connections)
+    for beam, ds, rows in read_granule(file, driver, credentials, single_pass, bbox if pushdown else None,
+                                       metadata_cache):
+        longitude = ds.pop("longitude")
+        latitude = ds.pop("latitude")
+        keep = ~np.isnat(ds["delta_time"].to_numpy())
+        for name, values in ds.items():
+            if name != "delta_time" and values.dtype.kind == "f":
+                keep &= ~np.isnan(values)
+        if bbox is not None:
+            keep &= in_bounding_box(longitude, latitude, bbox)
+        ds = {name: np.asarray(values)[keep] for name, values in ds.items()}
+        ds["beam"] = np.full(int(keep.sum()), BEAMS.index(beam), dtype=np.int8)
+        ds["longitude"] = longitude[keep]
+        ds["latitude"] = latitude[keep]
+        for name, values in ds.items():
+            columns.setdefault(name, []).append(values)
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+    if compact:
+        to_compact(columns)
+    return columns
+
+
+def assemble(results, output="geodataframe", compact=False):
+    """Concatenates the per-granule arrays of read_granule_arrays into one table
+
+    output: "geodataframe" (beam as strings, points built from longitude/latitude),
+        "dataframe" or "arrow" (latitude/longitude kept as float columns, beam categorical)
+    compact: the arrays are in the compact schema; beam is categorical for every output
+    """
+    columns = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+    if output == "geodataframe":
+        geometry = gpd.points_from_xy(columns.pop("longitude"), columns.pop("latitude"))
+        if compact:
+            columns["beam"] = pd.Categorical.from_codes(columns["beam"], categories=BEAMS)
+        else:
+            columns["beam"] = np.asarray(BEAMS)[columns["beam"]]
+        return gpd.GeoDataFrame(columns, geometry=geometry, crs="EPSG:4326")
+    elif output == "dataframe":
+        columns["beam"] = pd.Categorical.from_codes(columns["beam"], categories=BEAMS)
+        return pd.DataFrame(columns)
+    else:
+        columns["beam"] = pa.DictionaryArray.from_arrays(columns["beam"], BEAMS)
+        return pa.table(columns)
+
+
+def to_geodataframe(table):
+    """Returns the "dataframe" or "arrow" output of read_atl10 as a GeoDataFrame, building the point geometry"""
+    df = table if isinstance(table, pd.DataFrame) else table.to_pandas()
+    geometry = gpd.points_from_xy(df["longitude"], df["latitude"])
+    return gpd.GeoDataFrame(df.drop(columns=["longitude", "latitude"]), geometry=geometry, crs="EPSG:4326")
+
+
+def check_options(backend, output):
+    """Raises ValueError for a backend or output read_atl10 does not know"""
+    if backend not in ("threads", "processes"):
+        raise ValueError(f"unknown backend {backend!r}, expected 'threads' or 'processes'")
+    if output not in ("geodataframe", "dataframe", "arrow"):
+        raise ValueError(f"unknown output {output!r}, expected 'geodataframe', 'dataframe' or 'arrow'")
+
+
+def granule_name(file):
+    """Returns the granule name of an ATL10 URL or S3 path, without the .h5 extension"""
+    return os.path.splitext(os.path.basename(str(file)))[0]
+
+
+def raise_failures(results):
+    """pqdm returns exceptions in place of results; raise the first one"""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def read_atl10(files, bounding_box=None, executors=4, environment="local", credentials=None, single_pass=False,
+               backend="threads", pushdown=False, output="geodataframe", compact=False, metadata_cache=None,
+               pooled=False, max_connections=POOL_MAX_CONNECTIONS):
+    """Returns a consolidated GeoPandas dataframe for a set of ATL10 file pointers.
+
+    Parameters:
+        files (list[S3FSFile]): list of authenticated fsspec file references to ATL10 on S3 (via earthaccess)
+        executors (int): number of threads or processes
+        single_pass (bool): request the ancillary datasets and all six beams in one
+            non-blocking batch instead of waiting on the spacecraft orientation before
+            asking for the strong beams. Reads the weak beams too, but saves a round trip
+            per granule, which is what dominates over high latency connections.
+        backend (str): "threads" builds a GeoDataFrame per beam in a thread pool.
+            "processes" reads and filters each granule in a process pool, ships back
+            plain numpy arrays and builds the geometry once in the parent, so the
+            pandas work is not serialized by the GIL. Its result has a fresh RangeIndex.
+        pushdown (bool): with a bounding_box, read latitude and longitude first and only
+            the rows inside the box of the other datasets, as h5coro hyperslices. Costs a
+            round trip, saves most of the bytes when the box is small next to the track.
+        output (str): "geodataframe", or "dataframe" / "arrow" for a plain columnar table
+            with float latitude and longitude columns and a categorical beam. The columnar
+            outputs never build shapely points; use to_geodataframe() when geometry is needed.
+        compact (bool): return the compact schema, see to_compact(): categorical beam,
+            int32 delta_time seconds since 1970, float32 measurements and int8 flags.
+        metadata_cache (str or bool): path of a MetadataCache file, or True for
+            METADATA_CACHE_FILE, so repeat reads of a granule skip walking its metadata.
+        pooled (bool): share one keep-alive HTTP session or S3 client, and one credential
+            context, across all the files each worker process reads (see SessionPool)
+            instead of setting up new connections for every file.
+        max_connections (int): with pooled, the cap on concurrent connections per host
+            in each worker process.
+
+    """
+    bbox = parse_bounding_box(bounding_box)
+    check_options(backend, output)
+    if metadata_cache is True:
+        metadata_cache = METADATA_CACHE_FILE
+
+    if backend == "processes" or output != "geodataframe":
+        # Everything the worker needs travels with each task, the driver is created by the worker
+        read_arrays = partial(read_granule_arrays, environment=environment, credentials=credentials,
+                              bbox=bbox, single_pass=single_pass, pushdown=pushdown, compact=compact,
+                              metadata_cache=metadata_cache, pooled=pooled, max_connections=max_connections)
+        run = process_pqdm if backend == "processes" else pqdm
+        return assemble(raise_failures(run(files, read_arrays, n_jobs=executors)), output, compact)
+
+    driver = get_driver(environment, pooled, max_connections)
+    pushdown_bbox = bbox if pushdown else None
+
+    def read_h5coro(file):
+        """Reads datasets required for creating gridded freeboard from a single ATL10 file
+
+        file: an authenticated fsspec file reference on S3 (returned by earthaccess)
+
+        returns: a list of geopandas dataframes
+        """
+        # Create a list of geopandas.DataFrames containing beams
+        tracks = []
+        for beam, ds, rows in read_granule(file, driver, credentials, single_pass, pushdown_bbox, metadata_cache):
             # Add beam identifier
             ds["beam"] = beam
 
-            # Set fill values to NaN - assume 100 m as threshold
-            ds["beam_fb_height"] = np.where(ds["beam_fb_height"] > 100, np.nan, ds["beam_fb_height"])
-
             geometry = gpd.points_from_xy(ds["longitude"], ds["latitude"])
             del ds["longitude"]
             del ds["latitude"]
 
-            gdf = gpd.GeoDataFrame(ds, geometry=geometry, crs="EPSG:4326")
+            gdf = gpd.GeoDataFrame(ds, geometry=geometry, crs="EPSG:4326", index=rows)
             gdf.dropna(axis=0, inplace=True)
-            if bounding_box is not None:
-                bbox = [float(coord) for coord in bounding_box.split(",")]
+            if bbox is not None:
                 gdf = gdf.cx[bbox[0]:bbox[2],bbox[1]:bbox[3]]
             tracks.append(gdf)
 
         df = pd.concat(tracks)
+        if compact:
+            df["beam"] = pd.Categorical(df["beam"], categories=BEAMS)
+            to_compact(df)
         return df
 
-    dfs = pqdm(files, read_h5coro, n_jobs=executors)
+    dfs = raise_failures(pqdm(files, read_h5coro, n_jobs=executors))
     combined = pd.concat(dfs)
 
     return combined
 
 
+def iter_atl10(files, bounding_box=None, executors=4, environment="local", credentials=None, single_pass=False,
+               backend="threads", pushdown=False, output="arrow", compact=False, metadata_cache=None,
+               pooled=False, max_connections=POOL_MAX_CONNECTIONS):
+    """Yields a (file, table) pair for each ATL10 file as soon as it has been read.
+
+    Takes the same parameters as read_atl10 and yields one table per granule in the
+    order they complete. Only `executors` granules are read ahead of the consumer, so
+    memory is bounded by the number of workers rather than by the number of files.
+    Stops with the first exception raised by a worker.
+    """
+    bbox = parse_bounding_box(bounding_box)
+    check_options(backend, output)
+    if metadata_cache is True:
+        metadata_cache = METADATA_CACHE_FILE
+
+    read_arrays = partial(read_granule_arrays, environment=environment, credentials=credentials,
+                          bbox=bbox, single_pass=single_pass, pushdown=pushdown, compact=compact,
+                          metadata_cache=metadata_cache, pooled=pooled, max_connections=max_connections)
+    executor_class = ProcessPoolExecutor if backend == "processes" else ThreadPoolExecutor
+    files = iter(files)
+    with executor_class(max_workers=executors) as executor:
+        pending = {executor.submit(read_arrays, file): file for file in islice(files, executors)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = pending.pop(future)
+                arrays = future.result()
+                # Keep the workers busy while the consumer handles this granule
+                for next_file in islice(files, 1):
+                    pending[executor.submit(read_arrays, next_file)] = next_file
+                yield file, assemble([arrays], output, compact)
+
+
+class ParquetSink:
+    """Appends per-granule tables to a Parquet dataset partitioned by date and beam.
+
+    Files are laid out as root/date=YYYY-MM-DD/beam=gt1l/<granule>.parquet, readable with
+    pd.read_parquet(root) or pyarrow.dataset, which restore date and beam from the paths.
+    Every file is written under a temporary "_"-prefixed name, which dataset readers skip,
+    and renamed into place, and a granule is appended to root/_granules.txt only once all
+    of its files exist, so a job that dies loses at most the granules it was writing and
+    can skip the others when restarted. Temporary files left by such a job are removed
+    when the next sink is opened on the same root.
+
+    Parameters:
+        root (str): directory of the dataset, created if missing
+        row_group_size (int): rows per Parquet row group; each carries min/max statistics
+    """
+
+    MANIFEST = "_granules.txt"
+
+    def __init__(self, root, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        self.root = root
+        self.row_group_size = row_group_size
+        os.makedirs(root, exist_ok=True)
+        self.remove_temporary_files()
+        self.completed = set()
+        manifest = os.path.join(root, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as manifest_file:
+                self.completed = set(line.strip() for line in manifest_file if line.strip())
+
+    def write(self, file, table):
+        """Writes the table read from `file`, a "dataframe" or "arrow" output of read_atl10"""
+        if isinstance(table, pd.DataFrame):
+            table = pa.Table.from_pandas(table, preserve_index=False)
+        name = granule_name(file)
+        dates = table["delta_time"].to_numpy()
+        if dates.dtype.kind == "i":
+            # compact schema, seconds since 1970
+            dates = dates.astype("datetime64[s]")
+        dates = dates.astype("datetime64[D]")
+        beams = np.asarray(table["beam"].to_numpy(), dtype=str)
+        table = table.drop_columns(["beam"])
+        for date in np.unique(dates):
+            for beam in np.unique(beams[dates == date]):
+                rows = table.filter(pa.array((dates == date) & (beams == beam)))
+                directory = os.path.join(self.root, f"date={date}", f"beam={beam}")
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"{name}.parquet")
+                temporary_path = os.path.join(directory, f"_{name}.parquet.tmp")
+                pq.write_table(rows, temporary_path, row_group_size=self.row_group_size, write_statistics=True)
+                os.replace(temporary_path, path)
+        with open(os.path.join(self.root, self.MANIFEST), "a") as manifest_file:
+            manifest_file.write(name + "\n")
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        self.completed.add(name)
+
+    def remove_temporary_files(self):
+        """Removes the partial files of writes that never reached os.replace"""
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".parquet.tmp"):
+                    os.remove(os.path.join(directory, name))
+
+    def is_complete(self, file):
+        """Returns True when `file` was written completely by this or an earlier sink"""
+        return granule_name(file) in self.completed
@@ -12,7 +12,7 @@ import argparse
 import earthaccess
 from h5coro import h5coro, s3driver
 
-from read_atl10 import read_atl10
+from read_atl10 import ParquetSink, iter_atl10, read_atl10
 
 if __name__ == "__main__":
 
@@ -21,7 +21,11 @@ if __name__ == "__main__":
     parser.add_argument('--bbox', help='bbox')
     parser.add_argument('--year', help='year to process')
     parser.add_argument('--env', help='execute in the cloud or local, default:local')
-    parser.add_argument('--out', help='output file name')
+    parser.add_argument('--out', help='output name, granules are appended to the <out>.parquet dataset')
+    parser.add_argument('--backend', default='threads', help='read granules with threads or processes, default:threads')
+    parser.add_argument('--compact', action='store_true', help='write the compact schema (float32 measurements, int32 times)')
+    parser.add_argument('--metadata-cache', help='SQLite file caching granule metadata between runs, on the workers with --env cloud, default: none')
+    parser.add_argument('--pooled', action='store_true', help='share HTTP/S3 connections between granules')
     args = parser.parse_args()
 
 
@@ -45,13 +49,20 @@ if __name__ == "__main__":
     )
 
 
+    # Granules already in the dataset from an earlier (possibly interrupted) run are skipped
+    sink = ParquetSink(f"{args.out}.parquet")
+
     if args.env == "local":
         files = [g.data_links(access="out_of_region")[0] for g in granules]
+        files = [f for f in files if not sink.is_complete(f)]
         credentials = earthaccess.__auth__.token["access_token"]
 
-        df = read_atl10(files, bounding_box=args.bbox, environment="local", credentials=credentials)
+        tables = iter_atl10(files, bounding_box=args.bbox, environment="local", credentials=credentials,
+                            backend=args.backend, compact=args.compact, metadata_cache=args.metadata_cache,
+                            pooled=args.pooled)
     else:
         files = [g.data_links(access="direct")[0].replace("s3://", "") for g in granules]
+        files = [f for f in files if not sink.is_complete(f)]
         aws_credentials = earthaccess.get_s3_credentials("NSIDC")
         credentials = {
           "aws_access_key_id": aws_credentials["accessKeyId"],
@@ -62,13 +73,17 @@ if __name__ == "__main__":
         @coiled.function(region= "us-west-2",
                          memory= "4 GB",
                          keepalive="1 HOUR")
-        def cloud_runnner(files, bounding_box, credentials):
-            df = read_atl10(files, bounding_box=bounding_box, environment="cloud", credentials=credentials)
+        def cloud_runnner(file):
+            df = read_atl10([file], bounding_box=args.bbox, environment="cloud", credentials=credentials,
+                            backend=args.backend, output="arrow", compact=args.compact,
+                            metadata_cache=args.metadata_cache, pooled=args.pooled)
             return df
 
-        df = cloud_runnner(files, args.bbox, credentials=credentials)
-
+        # One granule per call, results stream back as they are read
+        tables = zip(files, cloud_runnner.map(files))
 
-    df.to_parquet(f"{args.out}.parquet")
-    rprint(df)
+    for file, table in tables:
+        sink.write(file, table)
+        rprint(f"{file}: {table.num_rows} rows")
 
+    rprint(f"{len(sink.completed)} granules in {sink.root}")
@@ -279,12 +279,13 @@ def clean_folder():
             os.rmdir(os.path.join(root, name))    
             
             
-def load_icesat2_as_dataframe(filepath, VARIABLES):
+def load_icesat2_as_dataframe(filepath, VARIABLES, compact=False):
     '''
     Load points from an ICESat-2 granule 'gt<beam>' groups as DataFrame of points. Uses VARIABLES mapping
     to select subset of '/gt<beam>/...' variables  (Assumes these variables share dimensions)
     Arguments:
         filepath to ATL0# granule
+        compact: if True, return the smaller dtypes of compact_dataframe()
     '''
     
     ds = h5py.File(filepath, 'r')
@@ -328,10 +329,44 @@ def load_icesat2_as_dataframe(filepath, VARIABLES):
     # Add filename column for book-keeping and reset index
     df['filename'] = Path(filepath).name
     df = df.reset_index(drop=True)
+
+    if compact:
+        df = compact_dataframe(df)
     
     return df
 
 
+# Columns that keep 64 bit floats in compact_dataframe(): float32 would round positions to about a metre
+FULL_PRECISION_COLUMNS = ['latitude', 'longitude', 'seg_dist_x']
+
+
+def compact_dataframe(df):
+    '''
+    Returns a copy of a load_icesat2_as_dataframe() DataFrame with smaller dtypes, roughly
+    halving its memory:
+        'beam' and 'filename' become categories
+        integer flags (e.g. height_segment_type) become the smallest integer type that fits them
+        float measurements become float32, except the FULL_PRECISION_COLUMNS
+        'delta_time' becomes int32 whole seconds since the ATLAS epoch (2018-01-01), which
+        convert_delta_time() still understands
+    '''
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if column in ('beam', 'filename'):
+            df[column] = values.astype('category')
+        elif column == 'delta_time':
+            if values.notna().all():
+                df[column] = np.floor(values).astype(np.int32)
+        elif column in FULL_PRECISION_COLUMNS:
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values):
+            df[column] = values.astype(np.float32)
+    return df
+
+
 
 def convert_to_gdf(df):
     '''